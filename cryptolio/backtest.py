@@ -2,16 +2,25 @@
 
 import configparser
 import datetime
-import json
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile
 
-import matplotlib.pyplot as plt
-import semidbm
+import numpy as np
 import undetected_chromedriver as uc
 from lxml import html
 
+from cryptolio.cache import CACHE_FORMATS, SnapshotCache, WeightsMemo
+from cryptolio.charts import CHART_FORMATS, save_charts, show_charts
+from cryptolio.ledger import TradeLedger
+from cryptolio.listings import HISTORICAL_URL, HistoricalListingFetcher
+from cryptolio.metrics import RiskMetrics
+from cryptolio.simulation import simulate
+from cryptolio.strategies import STRATEGIES, cap_weightings, get_strategy
+
 
 class Portfolio:
     def __init__(
@@ -21,13 +30,31 @@ class Portfolio:
         number_of_cryptos=20,
         fees=0.0025,
         cache_dir="backtest_cache",
+        cache_format="json",
+        fetcher="http",
+        listing_url=HISTORICAL_URL,
+        fetch_concurrency=8,
+        strategy="marketcap",
+        weights_memo_dir=None,
+        ledger_dir=None,
+        pipeline_depth=4,
     ):
         self.manual_weightings = manual_weightings
         self.fees = fees
         self.capping_level = capping_level
         self.number_of_cryptos = number_of_cryptos
-        self.db = semidbm.open(cache_dir, "c")
+        self.cache = SnapshotCache(cache_dir, cache_format)
+        self.weights_memo = WeightsMemo(weights_memo_dir) if weights_memo_dir else None
+        self.ledger_dir = ledger_dir
+        self.pipeline_depth = pipeline_depth
         self.driver = None
+        self.driver_lock = threading.Lock()
+        self.fetcher = None
+        if fetcher == "http":
+            self.fetcher = HistoricalListingFetcher(listing_url, fetch_concurrency)
+        self.strategy = get_strategy(strategy)
+        self.price_snapshots = {}
+        self.metrics = None
 
     def auto_scroll(self, driver, sleep):
         old_position = 0
@@ -85,14 +112,63 @@ class Portfolio:
             crypto_list.append(crypto)
         return crypto_list
 
-    def get_historical_top_cryptos(self, date, limit=20, forced_cryptos=[], excluded_cryptos=[]):
+    def prefetch(self, dates):
+        # Fetch all the missing snapshots concurrently before running the backtest
+        if not self.fetcher:
+            return
+        missing_dates = [date for date in dates if not self.cache.contains(date)]
+        if not missing_dates:
+            return
+        print(
+            "Cache miss, fetching", len(missing_dates), "historical snapshots from coinmarketcap..."
+        )
+        self.cache.put_many(
+            dict(
+                (date, crypto_list)
+                for date, crypto_list in self.fetcher.fetch(missing_dates).items()
+                if crypto_list
+            )
+        )
+
+    def load_crypto_list(self, date):
         try:
-            crypto_list = json.loads(self.db[str(date)].decode())
+            crypto_list = self.cache.get(date)
         except KeyError:
             print("Cache miss, fetching historical data from coinmarketcap...")
-            crypto_list = self.get_crypto_list(date)
+            crypto_list = []
+            if self.fetcher:
+                crypto_list = self.fetcher.fetch([date])[date]
+            if not crypto_list:
+                # Upcoming weeks are loaded from several threads but there is a single browser
+                with self.driver_lock:
+                    crypto_list = self.get_crypto_list(date)
             if crypto_list:
-                self.db[str(date)] = json.dumps(crypto_list)
+                self.cache.put(date, crypto_list)
+        return crypto_list
+
+    def get_price_snapshot(self, date, crypto_list=None):
+        if date not in self.price_snapshots:
+            if crypto_list is None:
+                crypto_list = self.load_crypto_list(date)
+            prices = {}
+            for crypto in crypto_list:
+                if crypto["usd_price"] and crypto["symbol"] not in prices:
+                    prices[crypto["symbol"]] = crypto["usd_price"]
+            self.price_snapshots[date] = prices
+        return self.price_snapshots[date]
+
+    def get_price_history(self, date, weeks):
+        return [
+            self.get_price_snapshot(date - datetime.timedelta(weeks=week))
+            for week in range(weeks, 0, -1)
+        ]
+
+    def get_historical_top_cryptos(self, date, limit=20, forced_cryptos=[], excluded_cryptos=[]):
+        return self.select_top_cryptos(
+            self.load_crypto_list(date), limit, forced_cryptos, excluded_cryptos
+        )
+
+    def select_top_cryptos(self, crypto_list, limit=20, forced_cryptos=[], excluded_cryptos=[]):
         top_cryptos = {}
         selected_cryptos = []
         appended = []
@@ -147,68 +223,94 @@ class Portfolio:
             cryptos = portfolio.keys()
         return sum([portfolio[crypto]["marketcap"] for crypto in cryptos])
 
-    def get_uncapped_cryptos(self, portfolio):
-        precision_error = 0.001
-        uncapped_cryptos = []
-        fixed_manual_weightings = {}
-        for crypto, weighting in self.manual_weightings.items():
-            if weighting not in ["auto", 0]:
-                fixed_manual_weightings[crypto] = weighting
-        for crypto, value in portfolio.items():
-            if (
-                crypto not in fixed_manual_weightings
-                and value["weighting"] > self.capping_level + precision_error
-            ) or (
-                crypto in fixed_manual_weightings
-                and abs(value["weighting"] - fixed_manual_weightings[crypto]) > precision_error
-            ):
-                uncapped_cryptos.append(crypto)
-        return sorted(uncapped_cryptos)
+    def get_historical_ideal_portfolio(self, date, capital, strategy=None):
+        return self.scale_portfolio(
+            self.get_target_weights(date, strategy or self.strategy), capital
+        )
+
+    def get_target_weights(self, date, strategy, top_cryptos=None):
+        key = None
+        if self.weights_memo:
+            key = self.weights_memo.get_key(
+                date,
+                self.capping_level,
+                self.number_of_cryptos,
+                self.manual_weightings,
+                strategy.name,
+            )
+            targets = self.weights_memo.get(key)
+            if targets is not None:
+                return targets
+        if top_cryptos is None:
+            forced_cryptos = [
+                crypto for crypto, quantity in self.manual_weightings.items() if quantity
+            ]
+            excluded_cryptos = [
+                crypto for crypto, quantity in self.manual_weightings.items() if not quantity
+            ]
+            top_cryptos = self.get_historical_top_cryptos(
+                date, self.number_of_cryptos, forced_cryptos, excluded_cryptos
+            )
+        weightings = cap_weightings(
+            strategy.get_weightings(
+                top_cryptos, self.get_price_history(date, strategy.history_weeks)
+            ),
+            self.capping_level,
+            self.manual_weightings,
+        )
+        targets = dict(
+            (crypto, dict(values, weighting=weightings[crypto]))
+            for crypto, values in top_cryptos.items()
+        )
+        if key:
+            self.weights_memo.put(key, targets)
+        return targets
 
-    def get_historical_ideal_portfolio(self, date, capital):
+    def prepare_week(self, date, strategies):
+        # Everything not depending on the previous portfolio, run ahead by the pipeline workers
         forced_cryptos = [crypto for crypto, quantity in self.manual_weightings.items() if quantity]
         excluded_cryptos = [
             crypto for crypto, quantity in self.manual_weightings.items() if not quantity
         ]
-        portfolio = self.get_historical_top_cryptos(
-            date, self.number_of_cryptos, forced_cryptos, excluded_cryptos
+        crypto_list = self.load_crypto_list(date)
+        self.get_price_snapshot(date, crypto_list)
+        top_cryptos = self.select_top_cryptos(
+            crypto_list, self.number_of_cryptos, forced_cryptos, excluded_cryptos
         )
-        total_market_cap = self.get_total_market_cap(portfolio)
-        for crypto, values in portfolio.items():
-            weighting = values["marketcap"] / total_market_cap
-            portfolio[crypto]["weighting"] = weighting
-            portfolio[crypto]["quantity"] = capital * weighting / values["usd_price"]
-        capped_cryptos = []
-        uncapped_cryptos = True
-        while uncapped_cryptos:
-            uncapped_cryptos = self.get_uncapped_cryptos(portfolio)
-            for crypto in uncapped_cryptos:
-                old_weighting = portfolio[crypto]["weighting"]
-                if crypto in self.manual_weightings and self.manual_weightings[crypto] not in [
-                    "auto",
-                    0,
-                ]:
-                    capping_level = self.manual_weightings[crypto]
-                else:
-                    capping_level = self.capping_level
-                portfolio[crypto]["weighting"] = capping_level
-                portfolio[crypto]["quantity"] *= capping_level / old_weighting
-                capped_cryptos.append(crypto)
-            weightings_sum_not_capped = sum(
-                [portfolio[key]["weighting"] for key in portfolio if key not in capped_cryptos]
-            )
-            weightings_sum_capped = sum(
-                [portfolio[key]["weighting"] for key in portfolio if key in capped_cryptos]
+        targets = dict(
+            (strategy.name, self.get_target_weights(date, strategy, top_cryptos))
+            for strategy in strategies
+        )
+        return crypto_list, targets
+
+    def iter_weeks(self, dates, strategies):
+        # Bounded pipeline: the next weeks are prepared while the current one is computed
+        if not self.pipeline_depth:
+            for date in dates:
+                yield date, self.prepare_week(date, strategies)
+            return
+        executor = ThreadPoolExecutor(self.pipeline_depth)
+        pending = deque()
+        dates = iter(dates)
+        try:
+            while True:
+                for date in dates:
+                    pending.append((date, executor.submit(self.prepare_week, date, strategies)))
+                    if len(pending) >= self.pipeline_depth:
+                        break
+                if not pending:
+                    return
+                date, future = pending.popleft()
+                yield date, future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def scale_portfolio(self, targets, capital):
+        portfolio = {}
+        for crypto, values in targets.items():
+            portfolio[crypto] = dict(
+                values, quantity=capital * values["weighting"] / values["usd_price"]
             )
-            for crypto in portfolio:
-                if crypto not in capped_cryptos:
-                    old_weighting = portfolio[crypto]["weighting"]
-                    new_weighting = (
-                        old_weighting * (1 - weightings_sum_capped) / weightings_sum_not_capped
-                    )
-                    portfolio[crypto]["weighting"] = new_weighting
-                    portfolio[crypto]["quantity"] *= new_weighting / old_weighting
-        assert abs(sum([values["weighting"] for crypto, values in portfolio.items()]) - 1) < 0.01
         assert abs(self.get_balance(portfolio) / capital - 1) < 0.01
         return portfolio
 
@@ -262,63 +364,352 @@ class Portfolio:
         for crypto in sorted(added_cryptos):
             print("Buy", new_portfolio[crypto]["quantity"], crypto, "(added in index)")
 
-    def backtest(self, capital, start_date, end_date, week_interval=1):
-        results = []
-        idx = (start_date.weekday() + 1) % 7
-        last_sunday = start_date - datetime.timedelta(idx)
-        original_portfolio = self.get_historical_ideal_portfolio(last_sunday, capital)
-        results.append((last_sunday, capital))
-        next_sunday = last_sunday + datetime.timedelta(weeks=week_interval)
-        end_date = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
-        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        while next_sunday <= end_date and next_sunday != today:
-            print("Date: " + str(next_sunday))
-            old_balance = self.get_balance(original_portfolio)
-            top_cryptos = self.get_historical_top_cryptos(
-                next_sunday, forced_cryptos=list(original_portfolio.keys())
-            )
-            self.update_portfolio_values(original_portfolio, top_cryptos)
-            new_balance = self.get_balance(original_portfolio)
-            print("Old balance: %.2f" % old_balance, "$")
-            next_portfolio = self.get_historical_ideal_portfolio(next_sunday, new_balance)
-            for crypto in next_portfolio:
-                if crypto in original_portfolio:
-                    next_portfolio[crypto]["quantity"] -= (
-                        abs(
-                            original_portfolio[crypto]["quantity"]
-                            - next_portfolio[crypto]["quantity"]
-                        )
-                        * 2
-                        * self.fees
+    def apply_fees(self, original_portfolio, next_portfolio, date=None, ledger=None, venue=None):
+        traded_value = 0
+        for crypto, values in original_portfolio.items():
+            if crypto not in next_portfolio:
+                traded_value += values["quantity"] * values["usd_price"]
+                if ledger:
+                    ledger.append(
+                        date, venue, crypto, "sell", values["quantity"], values["usd_price"]
                     )
-                else:
-                    next_portfolio[crypto]["quantity"] *= 1 - 2 * self.fees
-            new_balance = self.get_balance(next_portfolio)
-            variation = "+" if new_balance >= old_balance else ""
-            results.append((next_sunday, new_balance))
-            print(
-                "New balance:",
-                "%.2f" % new_balance,
-                "$",
-                variation + "%.2f" % (((new_balance / old_balance) - 1) * 100),
-                "%",
+        for crypto in next_portfolio:
+            price = next_portfolio[crypto]["usd_price"]
+            if crypto in original_portfolio:
+                traded_quantity = abs(
+                    original_portfolio[crypto]["quantity"] - next_portfolio[crypto]["quantity"]
+                )
+                side = (
+                    "buy"
+                    if next_portfolio[crypto]["quantity"] > original_portfolio[crypto]["quantity"]
+                    else "sell"
+                )
+                next_portfolio[crypto]["quantity"] -= traded_quantity * 2 * self.fees
+            else:
+                traded_quantity = next_portfolio[crypto]["quantity"]
+                side = "buy"
+                next_portfolio[crypto]["quantity"] *= 1 - 2 * self.fees
+            traded_value += traded_quantity * price
+            if ledger and traded_quantity:
+                ledger.append(
+                    date,
+                    venue,
+                    crypto,
+                    side,
+                    traded_quantity,
+                    price,
+                    traded_quantity * 2 * self.fees * price,
+                )
+        return traded_value
+
+    def open_ledger(self, week_interval):
+        if not self.ledger_dir:
+            return None
+        return TradeLedger(
+            self.ledger_dir,
+            "backtest",
+            "USD",
+            {
+                "capping_level": self.capping_level,
+                "number_of_cryptos": self.number_of_cryptos,
+                "fees": self.fees,
+                "week_interval": week_interval,
+            },
+        )
+
+    def get_prefetch_dates(self, start_date, end_date, week_interval=1, strategies=[]):
+        # Strategies using the past prices need every sunday before each rebalancing
+        history_weeks = max([strategy.history_weeks for strategy in strategies] or [0])
+        if not history_weeks:
+            return self.get_rebalancing_dates(start_date, end_date, week_interval)
+        return self.get_rebalancing_dates(
+            start_date - datetime.timedelta(weeks=history_weeks), end_date, 1
+        )
+
+    def iter_backtest(
+        self,
+        capital,
+        start_date,
+        end_date,
+        week_interval=1,
+        stop_drawdown=None,
+        stop_capital=None,
+        verbose=True,
+    ):
+        # Weekly states are yielded as soon as computed, the run ends after a stop condition
+        ledger = self.open_ledger(week_interval)
+        try:
+            self.prefetch(
+                self.get_prefetch_dates(start_date, end_date, week_interval, [self.strategy])
             )
-            print()
-            self.compare(original_portfolio, next_portfolio)
-            next_sunday += datetime.timedelta(weeks=week_interval)
-            original_portfolio = next_portfolio
-            print()
-            if next_sunday <= end_date and next_sunday != today:
-                print(
-                    "###############################################################################"
+            self.metrics = RiskMetrics(capital, 52 / week_interval)
+            dates = self.get_rebalancing_dates(start_date, end_date, week_interval)
+            original_portfolio = None
+            for next_sunday, (crypto_list, targets) in self.iter_weeks(dates, [self.strategy]):
+                if original_portfolio is None:
+                    original_portfolio = self.scale_portfolio(targets[self.strategy.name], capital)
+                    yield {
+                        "date": next_sunday,
+                        "balance": capital,
+                        "return": 0,
+                        "traded_value": 0,
+                        "fees": 0,
+                        "drawdown": 0,
+                        "max_drawdown": 0,
+                        "portfolio": original_portfolio,
+                        "stop": None,
+                    }
+                    continue
+                if verbose:
+                    print("Date: " + str(next_sunday))
+                old_balance = self.get_balance(original_portfolio)
+                top_cryptos = self.select_top_cryptos(
+                    crypto_list, forced_cryptos=list(original_portfolio.keys())
+                )
+                self.update_portfolio_values(original_portfolio, top_cryptos)
+                new_balance = self.get_balance(original_portfolio)
+                if verbose:
+                    print("Old balance: %.2f" % old_balance, "$")
+                next_portfolio = self.scale_portfolio(targets[self.strategy.name], new_balance)
+                traded_value = self.apply_fees(
+                    original_portfolio, next_portfolio, next_sunday, ledger, self.strategy.name
+                )
+                balance_before_fees = new_balance
+                new_balance = self.get_balance(next_portfolio)
+                self.metrics.update(new_balance, traded_value, balance_before_fees - new_balance)
+                drawdown = 1 - new_balance / self.metrics.peak
+                stop = get_stop(new_balance, drawdown, stop_drawdown, stop_capital)
+                if verbose:
+                    variation = "+" if new_balance >= old_balance else ""
+                    print(
+                        "New balance:",
+                        "%.2f" % new_balance,
+                        "$",
+                        variation + "%.2f" % (((new_balance / old_balance) - 1) * 100),
+                        "%",
+                    )
+                    print()
+                    self.compare(original_portfolio, next_portfolio)
+                yield {
+                    "date": next_sunday,
+                    "balance": new_balance,
+                    "return": new_balance / old_balance - 1,
+                    "traded_value": traded_value,
+                    "fees": balance_before_fees - new_balance,
+                    "drawdown": drawdown,
+                    "max_drawdown": self.metrics.max_drawdown,
+                    "portfolio": next_portfolio,
+                    "stop": stop,
+                }
+                if stop:
+                    if verbose:
+                        print()
+                        print("Backtest stopped on", stop, "threshold")
+                    return
+                original_portfolio = next_portfolio
+                if verbose:
+                    print()
+                    if next_sunday != dates[-1]:
+                        print(
+                            "###############################################################################"
+                        )
+                        print()
+        finally:
+            if ledger:
+                ledger.close()
+
+    def backtest(
+        self, capital, start_date, end_date, week_interval=1, stop_drawdown=None, stop_capital=None
+    ):
+        try:
+            return [
+                (state["date"], state["balance"])
+                for state in self.iter_backtest(
+                    capital, start_date, end_date, week_interval, stop_drawdown, stop_capital
                 )
+            ]
+        finally:
+            self.close()
+
+    def strategy_backtest(
+        self,
+        capital,
+        start_date,
+        end_date,
+        week_interval=1,
+        strategies=[],
+        stop_drawdown=None,
+        stop_capital=None,
+    ):
+        # Each snapshot is loaded and its top cryptos selected once for all the strategies
+        ledger = self.open_ledger(week_interval)
+        try:
+            strategies = [get_strategy(name) for name in strategies]
+            self.prefetch(self.get_prefetch_dates(start_date, end_date, week_interval, strategies))
+            results = dict((strategy.name, []) for strategy in strategies)
+            portfolios = {}
+            self.strategy_metrics = dict(
+                (strategy.name, RiskMetrics(capital, 52 / week_interval)) for strategy in strategies
+            )
+            stopped = []
+            dates = self.get_rebalancing_dates(start_date, end_date, week_interval)
+            for date, (crypto_list, targets) in self.iter_weeks(dates, strategies):
+                if len(stopped) == len(strategies):
+                    break
+                print("Date: " + str(date))
+                for strategy in strategies:
+                    if strategy.name in stopped:
+                        continue
+                    if strategy.name not in portfolios:
+                        portfolios[strategy.name] = self.scale_portfolio(
+                            targets[strategy.name], capital
+                        )
+                        results[strategy.name].append((date, capital))
+                        continue
+                    original_portfolio = portfolios[strategy.name]
+                    old_balance = self.get_balance(original_portfolio)
+                    self.update_portfolio_values(
+                        original_portfolio,
+                        self.select_top_cryptos(
+                            crypto_list, len(original_portfolio), list(original_portfolio.keys())
+                        ),
+                    )
+                    balance_before_fees = self.get_balance(original_portfolio)
+                    next_portfolio = self.scale_portfolio(
+                        targets[strategy.name], balance_before_fees
+                    )
+                    traded_value = self.apply_fees(
+                        original_portfolio, next_portfolio, date, ledger, strategy.name
+                    )
+                    new_balance = self.get_balance(next_portfolio)
+                    self.strategy_metrics[strategy.name].update(
+                        new_balance, traded_value, balance_before_fees - new_balance
+                    )
+                    results[strategy.name].append((date, new_balance))
+                    portfolios[strategy.name] = next_portfolio
+                    variation = "+" if new_balance >= old_balance else ""
+                    print(
+                        strategy.name + ":",
+                        "%.2f" % new_balance,
+                        "$",
+                        variation + "%.2f" % (((new_balance / old_balance) - 1) * 100),
+                        "%",
+                    )
+                    metrics = self.strategy_metrics[strategy.name]
+                    stop = get_stop(
+                        new_balance, 1 - new_balance / metrics.peak, stop_drawdown, stop_capital
+                    )
+                    if stop:
+                        print(strategy.name, "stopped on", stop, "threshold")
+                        stopped.append(strategy.name)
                 print()
+            return results
+        finally:
+            if ledger:
+                ledger.close()
+            self.close()
+
+    def close(self):
         if self.driver:
             self.driver.quit()
-        self.db.close()
+        self.cache.close()
+        if self.weights_memo:
+            self.weights_memo.close()
+
+    def get_rebalancing_dates(self, start_date, end_date, week_interval=1):
+        idx = (start_date.weekday() + 1) % 7
+        next_sunday = start_date - datetime.timedelta(idx)
+        end_date = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        dates = [next_sunday]
+        next_sunday += datetime.timedelta(weeks=week_interval)
+        while next_sunday <= end_date and next_sunday != today:
+            dates.append(next_sunday)
+            next_sunday += datetime.timedelta(weeks=week_interval)
+        return dates
+
+    def rolling_backtest(self, capital, start_date, end_date, week_interval=1):
+        # Target weights and prices only depend on the date, so every start date shares them
+        sundays = self.get_rebalancing_dates(start_date, end_date, 1)
+        self.prefetch(self.get_prefetch_dates(start_date, end_date, 1, [self.strategy]))
+        cryptos = {}
+        snapshots = []
+        for sunday in sundays:
+            snapshot_prices = {}
+            for crypto in self.load_crypto_list(sunday):
+                if crypto["symbol"] not in snapshot_prices:
+                    snapshot_prices[crypto["symbol"]] = crypto["usd_price"]
+                    cryptos.setdefault(crypto["symbol"], len(cryptos))
+            snapshots.append((snapshot_prices, self.get_historical_ideal_portfolio(sunday, 1)))
+        prices = np.full((len(sundays), len(cryptos)), np.nan)
+        weightings = np.zeros((len(sundays), len(cryptos)))
+        members = np.zeros((len(sundays), len(cryptos)), dtype=bool)
+        for week, (snapshot_prices, ideal_portfolio) in enumerate(snapshots):
+            for crypto, price in snapshot_prices.items():
+                if price:
+                    prices[week, cryptos[crypto]] = price
+            for crypto, values in ideal_portfolio.items():
+                prices[week, cryptos[crypto]] = values["usd_price"]
+                weightings[week, cryptos[crypto]] = values["weighting"]
+                members[week, cryptos[crypto]] = True
+        balances = np.full((len(sundays), len(sundays)), np.nan)
+        for offset in range(min(week_interval, len(sundays))):
+            weeks = list(range(offset, len(sundays), week_interval))
+            quantities = np.zeros((len(weeks), len(cryptos)))
+            holdings = np.zeros((len(weeks), len(cryptos)), dtype=bool)
+            week_prices = np.ones(len(cryptos))
+            for step, week in enumerate(weeks):
+                # Reuse the price of the previous rebalancing for a crypto missing from a snapshot
+                week_prices = np.where(np.isnan(prices[week]), week_prices, prices[week])
+                # Every start date already running is rebalanced at once
+                running = slice(0, step)
+                week_balances = quantities[running] @ week_prices
+                targets = week_balances[:, np.newaxis] * weightings[week] / week_prices
+                targets = np.where(
+                    holdings[running],
+                    targets - np.abs(quantities[running] - targets) * 2 * self.fees,
+                    targets * (1 - 2 * self.fees),
+                )
+                quantities[running] = np.where(members[week], targets, 0)
+                holdings[running] = members[week]
+                quantities[step] = capital * weightings[week] / week_prices
+                holdings[step] = members[week]
+                balances[weeks[:step], week] = quantities[running] @ week_prices
+                balances[week, week] = capital
+        results = {}
+        for start, start_sunday in enumerate(sundays):
+            results[start_sunday] = [
+                (sundays[week], balances[start, week])
+                for week in range(start, len(sundays), week_interval)
+            ]
         return results
 
 
+def get_stop(balance, drawdown, stop_drawdown=None, stop_capital=None):
+    if stop_drawdown is not None and drawdown >= stop_drawdown:
+        return "drawdown"
+    if stop_capital is not None and balance <= stop_capital:
+        return "capital"
+    return None
+
+
+def get_annualised_returns(rolling_results, min_weeks=52):
+    returns = []
+    for start_date, results in rolling_results.items():
+        weeks = (results[-1][0] - start_date).days / 7
+        if weeks < max(min_weeks, 1):
+            continue
+        returns.append((results[-1][1] / results[0][1]) ** (52 / weeks) - 1)
+    return np.array(returns)
+
+
+def get_params_label(params):
+    label = "capping_level=" + str(params[0]) + " and number_of_cryptos=" + str(params[1])
+    if len(params) > 2:
+        label += " and strategy=" + params[2]
+    return label
+
+
 def main():
     if len(sys.argv) < 2:
         print("Usage: cryptolio-backtest settings.cfg")
@@ -386,11 +777,78 @@ def main():
         print("Log scale must be true or false")
         exit(-1)
     log_scale = True if log_scale.lower() == "true" else False
+    chart_dir = config["BACKTEST"].get("chart_dir", "").strip()
+    chart_formats = [
+        chart_format.strip().lower()
+        for chart_format in config["BACKTEST"].get("chart_format", "png").split(",")
+    ]
+    for chart_format in chart_formats:
+        if chart_format not in CHART_FORMATS:
+            print("Chart format must be one of", ", ".join(CHART_FORMATS))
+            exit(-1)
+    chart_max_points = int(config["BACKTEST"].get("chart_max_points", "500"))
+    chart_top = int(config["BACKTEST"].get("chart_top", "0"))
+    if chart_max_points < 0 or chart_top < 0:
+        print("Chart max points and chart top must be positive integers")
+        exit(-1)
     cache_dir = config["BACKTEST"]["cache_dir"]
+    cache_format = config["BACKTEST"].get("cache_format", "json").strip().lower()
+    weights_memo_dir = config["BACKTEST"].get("weights_memo_dir", "").strip() or None
+    ledger_dir = config["BACKTEST"].get("ledger_dir", "").strip() or None
+    pipeline_depth = int(config["BACKTEST"].get("pipeline_depth", "4"))
+    if pipeline_depth < 0:
+        print("Pipeline depth must be a positive integer")
+        exit(-1)
+    if cache_format not in CACHE_FORMATS:
+        print("Cache format must be one of", ", ".join(CACHE_FORMATS))
+        exit(-1)
     if fees < 0:
         print("Fees must be a positive float")
         exit(-1)
+    fetcher = config["BACKTEST"].get("fetcher", "http").strip().lower()
+    if fetcher not in ["http", "chrome"]:
+        print("Fetcher must be http or chrome")
+        exit(-1)
+    listing_url = config["BACKTEST"].get("listing_url", HISTORICAL_URL).strip()
+    fetch_concurrency = int(config["BACKTEST"].get("fetch_concurrency", "8"))
+    if fetch_concurrency < 1:
+        print("Fetch concurrency must be a positive integer")
+        exit(-1)
+    rolling_starts = config["BACKTEST"].get("rolling_starts", "false")
+    if rolling_starts.lower() not in ["true", "false"]:
+        print("Rolling starts must be true or false")
+        exit(-1)
+    rolling_starts = True if rolling_starts.lower() == "true" else False
+    rolling_min_weeks = int(config["BACKTEST"].get("rolling_min_weeks", "52"))
+    simulation_paths = int(config["BACKTEST"].get("simulation_paths", "0"))
+    simulation_block_size = int(config["BACKTEST"].get("simulation_block_size", "4"))
+    simulation_workers = int(config["BACKTEST"].get("simulation_workers", "1"))
+    simulation_seed = config["BACKTEST"].get("simulation_seed", "").strip()
+    simulation_seed = int(simulation_seed) if simulation_seed else None
+    if simulation_paths < 0 or simulation_block_size < 1 or simulation_workers < 1:
+        print("Simulation paths, block size and workers must be positive integers")
+        exit(-1)
+    stop_drawdown = config["BACKTEST"].get("stop_drawdown", "").strip()
+    stop_drawdown = float(stop_drawdown) if stop_drawdown else None
+    if stop_drawdown is not None and (stop_drawdown <= 0 or stop_drawdown > 1):
+        print("Stop drawdown must be between 0 and 1")
+        exit(-1)
+    stop_capital = config["BACKTEST"].get("stop_capital", "").strip()
+    stop_capital = float(stop_capital) if stop_capital else None
+    if stop_capital is not None and stop_capital < 0:
+        print("Stop capital must be a positive number")
+        exit(-1)
+    strategies = [
+        strategy.strip().lower()
+        for strategy in config["BACKTEST"].get("strategies", "marketcap").split(",")
+    ]
+    for strategy in strategies:
+        if strategy not in STRATEGIES:
+            print("Strategy must be one of", ", ".join(STRATEGIES))
+            exit(-1)
     backtests = {}
+    metrics = {}
+    rolling_backtests = {}
     for capping_level in capping_level_list:
         for number_of_cryptos in number_of_cryptos_list:
             if capping_level * number_of_cryptos < 1:
@@ -412,11 +870,49 @@ def main():
             )
             print("###############################################################################")
             portfolio = Portfolio(
-                manual_weightings, capping_level, number_of_cryptos, fees, cache_dir
-            )
-            backtests[(capping_level, number_of_cryptos)] = portfolio.backtest(
-                capital, start_date, end_date, week_interval
+                manual_weightings,
+                capping_level,
+                number_of_cryptos,
+                fees,
+                cache_dir,
+                cache_format,
+                fetcher,
+                listing_url,
+                fetch_concurrency,
+                strategies[0],
+                weights_memo_dir,
+                ledger_dir,
+                pipeline_depth,
             )
+            if len(strategies) == 1:
+                if rolling_starts:
+                    rolling_backtests[
+                        (capping_level, number_of_cryptos)
+                    ] = portfolio.rolling_backtest(capital, start_date, end_date, week_interval)
+                backtests[(capping_level, number_of_cryptos)] = portfolio.backtest(
+                    capital, start_date, end_date, week_interval, stop_drawdown, stop_capital
+                )
+                metrics[(capping_level, number_of_cryptos)] = portfolio.metrics.get_summary()
+                continue
+            if rolling_starts:
+                for strategy in strategies:
+                    portfolio.strategy = get_strategy(strategy)
+                    rolling_backtests[
+                        (capping_level, number_of_cryptos, strategy)
+                    ] = portfolio.rolling_backtest(capital, start_date, end_date, week_interval)
+            for strategy, results in portfolio.strategy_backtest(
+                capital,
+                start_date,
+                end_date,
+                week_interval,
+                strategies,
+                stop_drawdown,
+                stop_capital,
+            ).items():
+                backtests[(capping_level, number_of_cryptos, strategy)] = results
+                metrics[(capping_level, number_of_cryptos, strategy)] = portfolio.strategy_metrics[
+                    strategy
+                ].get_summary()
     print("Final capital:")
     final_capital = []
     for params, backtest in backtests.items():
@@ -424,56 +920,95 @@ def main():
     for capital, params in sorted(final_capital, reverse=True):
         print(
             "%.2f" % capital,
-            "$ with capping_level=" + str(params[0]),
-            "and number_of_cryptos=" + str(params[1]),
+            "$ with " + get_params_label(params),
         )
     print()
+    print("Risk metrics (Sharpe ratio | volatility | max drawdown | turnover | fees paid):")
+    for params, summary in sorted(
+        metrics.items(), key=lambda item: item[1]["sharpe_ratio"], reverse=True
+    ):
+        print(
+            "%.2f" % summary["sharpe_ratio"],
+            "| %.2f%%" % (summary["volatility"] * 100),
+            "| %.2f%%" % (summary["max_drawdown"] * 100),
+            "| %.2f%%" % (summary["turnover"] * 100),
+            "| %.2f $ (%.2f%% fee drag)" % (summary["fees"], summary["fee_drag"] * 100),
+            "with " + get_params_label(params),
+        )
+    print()
+    if simulation_paths:
+        print(
+            "Simulated final capital and max drawdown (5% | median | 95%) over",
+            simulation_paths,
+            "paths:",
+        )
+        for params, backtest in backtests.items():
+            simulation = simulate(
+                backtest,
+                simulation_paths,
+                simulation_block_size,
+                workers=simulation_workers,
+                seed=simulation_seed,
+            )
+            if not simulation:
+                print("Not enough weeks to simulate with " + get_params_label(params))
+                continue
+            print(
+                " | ".join("%.2f $" % value for value in simulation["final_capital"]),
+                "and",
+                " | ".join("%.2f%%" % (value * 100) for value in simulation["max_drawdown"]),
+                "with " + get_params_label(params),
+            )
+        print()
+    if rolling_starts:
+        print("Rolling start annualised returns (min | 5% | median | 95% | max):")
+        for params, results in rolling_backtests.items():
+            returns = get_annualised_returns(results, rolling_min_weeks)
+            if not len(returns):
+                print(
+                    "Not enough weeks for rolling starts with " + get_params_label(params) + ",",
+                    "decrease rolling_min_weeks",
+                )
+                continue
+            print(
+                " | ".join(
+                    "%.2f%%" % (value * 100)
+                    for value in np.quantile(returns, [0, 0.05, 0.5, 0.95, 1])
+                ),
+                "with " + get_params_label(params),
+                "(" + str(len(returns)),
+                "start dates)",
+            )
+        print()
     wins = {}
-    first_serie = backtests[list(backtests.keys())[0]]
-    for i in range(0, len(first_serie)):
+    # Stopped backtests are shorter, they only compete while they run
+    longest_serie = max(backtests.values(), key=len)
+    for i in range(0, len(longest_serie)):
         winner_value = 0
         winner_params = None
         for params, backtest in backtests.items():
-            if backtest[i][1] > winner_value:
+            if i < len(backtest) and backtest[i][1] > winner_value:
                 winner_value = backtest[i][1]
                 winner_params = params
         if winner_params not in wins:
             wins[winner_params] = 1
         else:
             wins[winner_params] += 1
-    assert sum(wins.values()) == len(first_serie)
+    assert sum(wins.values()) == len(longest_serie)
     best_params = max(wins, key=wins.get)
     print(
-        "The parameters with the maximum number of wins are capping_level=" + str(best_params[0]),
-        "and number_of_cryptos=" + str(best_params[1]),
+        "The parameters with the maximum number of wins are " + get_params_label(best_params),
     )
     print()
     if not draw_charts:
         return
-    x = [str(c) + " - " + str(s) for c, s in sorted(list(wins.keys()))]
-    y = [wins[params] for params in sorted(list(wins.keys()))]
-    plt.figure(0, figsize=(15, 8))
-    plt.title("Winners")
-    plt.xlabel("Parameters")
-    plt.bar(x, y)
-    plt.ylabel("Number of wins")
-    plt.figure(1, figsize=(15, 8))
-    plt.title("Profit")
-    if log_scale:
-        plt.yscale("log")
-    plt.ylabel("Capital")
-    legend = []
-    for capping_level in capping_level_list:
-        for number_of_cryptos in number_of_cryptos_list:
-            if capping_level * number_of_cryptos < 1:
-                continue
-            legend.append(str(capping_level) + " - " + str(number_of_cryptos))
-            results = backtests[(capping_level, number_of_cryptos)]
-            x = [tup[0] for tup in results]
-            y = [tup[1] for tup in results]
-            plt.plot(x, y)
-    plt.legend(legend, loc="upper left")
-    plt.show()
+    if chart_dir:
+        for path in save_charts(
+            backtests, wins, log_scale, chart_dir, chart_formats, chart_max_points, chart_top
+        ):
+            print("Chart saved to", path)
+    else:
+        show_charts(backtests, wins, log_scale, chart_max_points, chart_top)
 
 
 if __name__ == "__main__":
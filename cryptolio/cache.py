@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+import array
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from binascii import crc32
+
+import semidbm
+from semidbm.exceptions import DBMError, DBMLoadError
+
+CACHE_FORMATS = ["json", "packed"]
+PACKED_HEADER = struct.Struct("<4sI")
+PACKED_MAGIC = b"CPK1"
+STRINGS_KEY = "__strings__"
+DATA_FILE = "data"
+LOCK_FILE = "lock"
+# semidbm data file layout: an 8 bytes file header, then records of key size, value size,
+# key, value and a crc32 of the key and value, a deleted key having a value size of -1
+DBM_HEADER_SIZE = 8
+RECORD_HEADER = struct.Struct("!ii")
+# Bumped when the selection or capping changes to ignore the old memos
+MEMO_VERSION = "1"
+
+
+def shuffle_bytes(values, width=8):
+    # Group the n-th byte of every value together, exponents and high bytes then compress well
+    data = values.tobytes()
+    return b"".join(data[i::width] for i in range(width))
+
+
+def unshuffle_bytes(data, typecode, width=8):
+    count = len(data) // width
+    interleaved = bytearray(len(data))
+    for i in range(width):
+        interleaved[i::width] = data[i * count : (i + 1) * count]
+    return array.array(typecode, bytes(interleaved))
+
+
+def delta_encode(values):
+    previous = 0
+    deltas = array.array("i")
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+
+def delta_decode(deltas):
+    values = []
+    value = 0
+    for delta in deltas:
+        value += delta
+        values.append(value)
+    return values
+
+
+def get_complete_size(data_file, offset=DBM_HEADER_SIZE):
+    # Walk the records from a known complete offset, a crashed append leaves a partial one
+    size = os.path.getsize(data_file)
+    with open(data_file, "rb") as data:
+        data.seek(offset)
+        while offset + RECORD_HEADER.size <= size:
+            key_size, value_size = RECORD_HEADER.unpack(data.read(RECORD_HEADER.size))
+            value_size = max(value_size, 0)
+            end = offset + RECORD_HEADER.size + key_size + value_size + 4
+            if key_size < 0 or end > size:
+                break
+            record = data.read(key_size + value_size)
+            (checksum,) = struct.unpack("!I", data.read(4))
+            if crc32(record) & 0xFFFFFFFF != checksum:
+                break
+            offset = end
+    return offset
+
+
+class SharedDb:
+    # Many readers and a single locked writer, the data file is only appended to or replaced
+    verify_checksums = False
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        # semidbm reads share a file offset, threads of a process go through this lock
+        self.thread_lock = threading.RLock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_file = open(os.path.join(cache_dir, LOCK_FILE), "a")
+        self.complete_size = (None, DBM_HEADER_SIZE)
+        with self.lock(fcntl.LOCK_EX):
+            if not os.path.exists(self.get_data_file()):
+                semidbm.open(cache_dir, "c").close()
+            self.repair()
+        self.db = None
+        self.writer = None
+        self.open()
+
+    def get_data_file(self):
+        return os.path.join(self.cache_dir, DATA_FILE)
+
+    @contextlib.contextmanager
+    def lock(self, operation):
+        fcntl.flock(self.lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def repair(self):
+        # Called under the exclusive lock, drops what a crashed writer left after the last record
+        data_file = self.get_data_file()
+        stat = os.stat(data_file)
+        inode, size = self.complete_size
+        if inode != stat.st_ino or size > stat.st_size:
+            size = DBM_HEADER_SIZE
+        if size != stat.st_size:
+            size = get_complete_size(data_file, size)
+            if size != stat.st_size:
+                print(
+                    "Dropping", stat.st_size - size, "bytes of incomplete records from", data_file
+                )
+                os.truncate(data_file, size)
+        self.complete_size = (stat.st_ino, size)
+
+    def open(self):
+        with self.thread_lock:
+            if self.db:
+                self.db.close()
+                self.db = None
+            try:
+                with self.lock(fcntl.LOCK_SH):
+                    self.db = semidbm.open(
+                        self.cache_dir, "r", verify_checksums=self.verify_checksums
+                    )
+                    stat = os.stat(self.get_data_file())
+            except DBMLoadError:
+                # A writer crashed since this process checked the data file
+                with self.lock(fcntl.LOCK_EX):
+                    self.repair()
+                    self.db = semidbm.open(
+                        self.cache_dir, "r", verify_checksums=self.verify_checksums
+                    )
+                    stat = os.stat(self.get_data_file())
+            self.data_version = (stat.st_ino, stat.st_size)
+
+    def refresh(self):
+        # The index is loaded when opening, reopen if another process wrote or compacted since
+        with self.thread_lock:
+            stat = os.stat(self.get_data_file())
+            if (stat.st_ino, stat.st_size) == self.data_version:
+                return False
+            self.open()
+            return True
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self.thread_lock, self.lock(fcntl.LOCK_EX):
+            # Opened under the lock, the index includes the writes of the other processes
+            self.repair()
+            self.writer = semidbm.open(self.cache_dir, "w")
+            try:
+                yield
+            finally:
+                self.writer.close()
+                self.writer = None
+            # Only a write that completed moves the known complete size forward
+            stat = os.stat(self.get_data_file())
+            self.complete_size = (stat.st_ino, stat.st_size)
+
+    def compact(self):
+        # Live records are copied to a new data file which then atomically replaces the old one
+        with self.thread_lock, self.lock(fcntl.LOCK_EX):
+            self.repair()
+            source = semidbm.open(self.cache_dir, "r")
+            temp_dir = tempfile.mkdtemp(prefix=".compact-", dir=self.cache_dir)
+            try:
+                target = semidbm.open(temp_dir, "n")
+                for key in source.keys():
+                    target[key] = source[key]
+                target.close()
+                os.replace(os.path.join(temp_dir, DATA_FILE), self.get_data_file())
+                stat = os.stat(self.get_data_file())
+                self.complete_size = (stat.st_ino, stat.st_size)
+            finally:
+                source.close()
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        self.open()
+
+    def close(self):
+        self.db.close()
+        self.lock_file.close()
+
+
+class SnapshotCache(SharedDb):
+    def __init__(self, cache_dir, cache_format="json"):
+        self.cache_format = cache_format
+        super().__init__(cache_dir)
+
+    def open(self):
+        with self.thread_lock:
+            super().open()
+            self.strings = None
+            self.string_ids = None
+            self.string_chunks = 0
+
+    @contextlib.contextmanager
+    def writing(self):
+        with super().writing():
+            # Another process may have added strings to the dictionary
+            self.strings = None
+            self.string_chunks = 0
+            self.load_strings(self.writer)
+            yield
+
+    def load_strings(self, db=None):
+        # The dictionary is stored as append-only chunks to avoid rewriting it for each snapshot
+        if self.strings is not None:
+            return
+        db = db or self.db
+        self.strings = []
+        while True:
+            try:
+                self.strings += json.loads(db[STRINGS_KEY + str(self.string_chunks)].decode())
+            except KeyError:
+                break
+            self.string_chunks += 1
+        self.string_ids = dict((string, i) for i, string in enumerate(self.strings))
+
+    def intern(self, strings):
+        self.load_strings()
+        new_strings = []
+        ids = []
+        for string in strings:
+            if string not in self.string_ids:
+                self.string_ids[string] = len(self.strings)
+                self.strings.append(string)
+                new_strings.append(string)
+            ids.append(self.string_ids[string])
+        if new_strings:
+            self.writer[STRINGS_KEY + str(self.string_chunks)] = json.dumps(new_strings)
+            self.string_chunks += 1
+        return ids
+
+    def encode(self, crypto_list):
+        symbol_ids = self.intern([crypto["symbol"] for crypto in crypto_list])
+        name_ids = self.intern([crypto["name"] for crypto in crypto_list])
+        columns = [
+            delta_encode(symbol_ids),
+            array.array("i", [name - symbol for name, symbol in zip(name_ids, symbol_ids)]),
+            array.array("d", [crypto["marketcap"] for crypto in crypto_list]),
+            array.array("d", [crypto["usd_price"] for crypto in crypto_list]),
+        ]
+        if sys.byteorder == "big":
+            for column in columns:
+                column.byteswap()
+        payload = b"".join(
+            [columns[0].tobytes(), columns[1].tobytes()]
+            + [shuffle_bytes(column) for column in columns[2:]]
+        )
+        return PACKED_HEADER.pack(PACKED_MAGIC, len(crypto_list)) + zlib.compress(payload)
+
+    def decode(self, data, strings):
+        _, count = PACKED_HEADER.unpack_from(data)
+        payload = zlib.decompress(data[PACKED_HEADER.size :])
+        int_size = 4 * count
+        symbol_deltas = array.array("i", payload[:int_size])
+        name_offsets = array.array("i", payload[int_size : 2 * int_size])
+        marketcaps = unshuffle_bytes(payload[2 * int_size : 2 * int_size + 8 * count], "d")
+        prices = unshuffle_bytes(payload[2 * int_size + 8 * count :], "d")
+        if sys.byteorder == "big":
+            for column in [symbol_deltas, name_offsets, marketcaps, prices]:
+                column.byteswap()
+        symbol_ids = delta_decode(symbol_deltas)
+        return [
+            {
+                "name": strings[symbol_id + name_offset],
+                "symbol": strings[symbol_id],
+                "marketcap": marketcap,
+                "usd_price": price,
+            }
+            for symbol_id, name_offset, marketcap, price in zip(
+                symbol_ids, name_offsets, marketcaps, prices
+            )
+        ]
+
+    def contains(self, date):
+        # semidbm keys are bytes
+        key = str(date).encode()
+        with self.thread_lock:
+            return key in self.db or (self.refresh() and key in self.db)
+
+    def get(self, date):
+        with self.thread_lock:
+            if not self.contains(date):
+                raise KeyError(str(date))
+            data = self.db[str(date)]
+            if data.startswith(PACKED_MAGIC):
+                # The strings are loaded under the lock, the decoding itself is done outside
+                self.load_strings()
+                strings = self.strings
+            else:
+                strings = None
+        if strings is not None:
+            return self.decode(data, strings)
+        return json.loads(data.decode())
+
+    def write(self, date, crypto_list, cache_format=None, overwrite=True):
+        if not overwrite and str(date).encode() in self.writer:
+            return False
+        if (cache_format or self.cache_format) == "packed":
+            self.writer[str(date)] = self.encode(crypto_list)
+        else:
+            self.writer[str(date)] = json.dumps(crypto_list)
+        return True
+
+    def put(self, date, crypto_list, cache_format=None, overwrite=True):
+        with self.writing():
+            return self.write(date, crypto_list, cache_format, overwrite)
+
+    def put_many(self, crypto_lists, cache_format=None):
+        with self.writing():
+            for date, crypto_list in crypto_lists.items():
+                self.write(date, crypto_list, cache_format)
+
+    def keys(self):
+        with self.thread_lock:
+            self.refresh()
+            return sorted(
+                key.decode() for key in self.db.keys() if not key.decode().startswith(STRINGS_KEY)
+            )
+
+    def convert(self, cache_format):
+        keys = self.keys()
+        with self.writing():
+            for key in keys:
+                self.write(key, self.get(key), cache_format)
+        self.compact()
+
+
+class WeightsMemo(SharedDb):
+    # Target weights only depend on the date and the index parameters, never on the capital
+    verify_checksums = True
+
+    def get_key(self, date, capping_level, number_of_cryptos, manual_weightings, strategy):
+        weightings_hash = hashlib.sha1(
+            json.dumps(manual_weightings, sort_keys=True).encode()
+        ).hexdigest()
+        return "|".join(
+            [
+                MEMO_VERSION,
+                str(date),
+                repr(capping_level),
+                str(number_of_cryptos),
+                weightings_hash,
+                strategy,
+            ]
+        )
+
+    def get(self, key):
+        # A memo is only an optimisation, what cannot be read is computed again
+        try:
+            with self.thread_lock:
+                if key.encode() not in self.db and not (self.refresh() and key.encode() in self.db):
+                    return None
+                data = self.db[key]
+            return json.loads(data.decode())
+        except (KeyError, ValueError, DBMError):
+            return None
+
+    def put(self, key, targets):
+        with self.writing():
+            self.writer[key] = json.dumps(targets)
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "compact":
+        cache = SnapshotCache(sys.argv[2])
+        size = os.path.getsize(cache.get_data_file())
+        cache.compact()
+        print(
+            "Cache compacted from",
+            size,
+            "to",
+            os.path.getsize(cache.get_data_file()),
+            "bytes",
+        )
+        cache.close()
+        return
+    if len(sys.argv) < 4 or sys.argv[1] != "convert" or sys.argv[3] not in CACHE_FORMATS:
+        print("Usage: cryptolio-cache convert cache_dir json|packed")
+        print("       cryptolio-cache compact cache_dir")
+        exit(-1)
+    cache = SnapshotCache(sys.argv[2])
+    cache.convert(sys.argv[3])
+    print(len(cache.keys()), "snapshots converted to", sys.argv[3])
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
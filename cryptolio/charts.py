@@ -0,0 +1,141 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+CHART_FORMATS = ["png", "svg", "html"]
+
+
+def format_params(params):
+    return " - ".join(str(param) for param in params)
+
+
+def decimate(x, y, max_points):
+    # Keep the min and the max of each bucket so that peaks and drawdowns stay visible
+    if not max_points:
+        return list(x), list(y)
+    # The endpoints and the min and max of one bucket are always kept
+    max_points = max(max_points, 4)
+    if len(y) <= max_points:
+        return list(x), list(y)
+    values = np.asarray(y, dtype=float)
+    bucket_count = max((max_points - 2) // 2, 1)
+    bounds = np.linspace(0, len(values), bucket_count + 1, dtype=int)
+    indexes = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
+        bucket = values[start:end]
+        indexes.append(start + int(np.argmin(bucket)))
+        indexes.append(start + int(np.argmax(bucket)))
+    indexes = sorted(set(indexes) | {0, len(values) - 1})
+    return [x[i] for i in indexes], [y[i] for i in indexes]
+
+
+def get_top_backtests(backtests, top):
+    if not top or top >= len(backtests):
+        return backtests
+    ranking = sorted(backtests, key=lambda params: backtests[params][-1][1], reverse=True)
+    return dict((params, backtests[params]) for params in ranking[:top])
+
+
+def get_chart_series(backtests, max_points=500, top=0):
+    series = []
+    for params, results in get_top_backtests(backtests, top).items():
+        x, y = decimate([tup[0] for tup in results], [tup[1] for tup in results], max_points)
+        series.append((format_params(params), x, y))
+    return series
+
+
+def get_winners_data(wins):
+    x = [format_params(params) for params in sorted(list(wins.keys()))]
+    y = [wins[params] for params in sorted(list(wins.keys()))]
+    return x, y
+
+
+def draw_winners(figure, x, y):
+    axes = figure.add_subplot()
+    axes.set_title("Winners")
+    axes.set_xlabel("Parameters")
+    axes.bar(x, y)
+    axes.set_ylabel("Number of wins")
+    axes.tick_params(axis="x", labelrotation=90)
+
+
+def draw_profit(figure, series, log_scale):
+    axes = figure.add_subplot()
+    axes.set_title("Profit")
+    if log_scale:
+        axes.set_yscale("log")
+    axes.set_ylabel("Capital")
+    for label, x, y in series:
+        axes.plot(x, y, label=label)
+    axes.legend(loc="upper left")
+
+
+def render_chart(name, data, log_scale, chart_format, path):
+    figure = Figure(figsize=(15, 8))
+    FigureCanvasAgg(figure)
+    if name == "winners":
+        draw_winners(figure, *data)
+    else:
+        draw_profit(figure, data, log_scale)
+    figure.tight_layout()
+    if chart_format == "html":
+        svg = io.StringIO()
+        figure.savefig(svg, format="svg")
+        with open(path, "w") as html_file:
+            html_file.write(
+                "<!DOCTYPE html>\n<html>\n<head><meta charset='utf-8'><title>"
+                + name.capitalize()
+                + "</title></head>\n<body>\n"
+                + svg.getvalue()
+                + "\n</body>\n</html>\n"
+            )
+    else:
+        figure.savefig(path, format=chart_format)
+    return path
+
+
+def save_charts(
+    backtests,
+    wins,
+    log_scale,
+    chart_dir,
+    chart_formats=("png",),
+    max_points=500,
+    top=0,
+    workers=None,
+):
+    os.makedirs(chart_dir, exist_ok=True)
+    charts = {
+        "winners": get_winners_data(wins),
+        "profit": get_chart_series(backtests, max_points, top),
+    }
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                render_chart,
+                name,
+                data,
+                log_scale,
+                chart_format,
+                os.path.join(chart_dir, name + "." + chart_format),
+            )
+            for name, data in charts.items()
+            for chart_format in chart_formats
+        ]
+        return [future.result() for future in futures]
+
+
+def show_charts(backtests, wins, log_scale, max_points=500, top=0):
+    import matplotlib.pyplot as plt
+
+    draw_winners(plt.figure(0, figsize=(15, 8)), *get_winners_data(wins))
+    draw_profit(
+        plt.figure(1, figsize=(15, 8)), get_chart_series(backtests, max_points, top), log_scale
+    )
+    plt.show()
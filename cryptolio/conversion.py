@@ -0,0 +1,101 @@
+from collections import deque
+
+BTC = "BTC"
+USD = "USDT"
+
+
+def get_last_price(ticker):
+    price = ticker.get("last") if ticker else None
+    if not price or price <= 0:
+        return None
+    return price
+
+
+class ConversionGraph:
+    # Conversion rates to BTC through the markets with the fewest hops
+    def __init__(self, tickers):
+        self.prices = {}
+        for symbol in tickers:
+            self.set_price(symbol, get_last_price(tickers[symbol]))
+        self.build()
+
+    def set_price(self, symbol, price):
+        # Derivatives like BTC/USDT:USDT are not spot conversions
+        if ":" in symbol or symbol.count("/") != 1:
+            return False
+        if price is None:
+            return self.prices.pop(symbol, None) is not None
+        topology_changed = symbol not in self.prices
+        self.prices[symbol] = price
+        return topology_changed
+
+    def get_edge_rate(self, node, neighbor):
+        symbol = self.edges[node][neighbor]
+        price = self.prices[symbol]
+        return price if symbol.split("/")[0] == node else 1 / price
+
+    def build(self):
+        self.edges = {}
+        for symbol in sorted(self.prices):
+            base, quote = symbol.split("/")
+            for node, neighbor in [(base, quote), (quote, base)]:
+                self.edges.setdefault(node, {}).setdefault(neighbor, symbol)
+        self.rates = {BTC: 1}
+        self.parents = {BTC: None}
+        self.children = {BTC: []}
+        queue = deque([BTC])
+        while queue:
+            node = queue.popleft()
+            for neighbor in sorted(self.edges.get(node, {})):
+                if neighbor in self.rates:
+                    continue
+                self.parents[neighbor] = node
+                self.children[node].append(neighbor)
+                self.children[neighbor] = []
+                self.rates[neighbor] = self.get_edge_rate(neighbor, node) * self.rates[node]
+                queue.append(neighbor)
+
+    def update_subtree(self, root):
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            parent = self.parents[node]
+            self.rates[node] = self.get_edge_rate(node, parent) * self.rates[parent]
+            stack += self.children[node]
+
+    def update(self, symbol, ticker):
+        self.update_tickers({symbol: ticker}, full=False)
+
+    def update_tickers(self, tickers, full=True):
+        # A new or removed market may change the paths, a new price only the rates below it
+        if full:
+            tickers = dict(tickers)
+            for symbol in self.prices:
+                tickers.setdefault(symbol, None)
+        changed_symbols = []
+        topology_changed = False
+        for symbol, ticker in tickers.items():
+            price = get_last_price(ticker)
+            if price == self.prices.get(symbol):
+                continue
+            topology_changed |= self.set_price(symbol, price)
+            if symbol in self.prices:
+                changed_symbols.append(symbol)
+        if topology_changed:
+            self.build()
+            return
+        for symbol in changed_symbols:
+            base, quote = symbol.split("/")
+            for node, parent in [(base, quote), (quote, base)]:
+                if self.parents.get(node) == parent and self.edges[node][parent] == symbol:
+                    self.update_subtree(node)
+
+    def get_rate(self, crypto, currency="BTC"):
+        if currency == "BTC":
+            return self.rates.get(crypto)
+        elif currency == "USD":
+            if crypto not in self.rates or USD not in self.rates:
+                return None
+            return self.rates[crypto] / self.rates[USD]
+        else:
+            raise NotImplementedError
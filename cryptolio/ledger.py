@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import sys
+from array import array
+
+import numpy as np
+
+# Fixed-width columns: the number of trades is the file size divided by the width
+COLUMNS = [
+    ("timestamp", "q", np.int64),
+    ("venue", "i", np.int32),
+    ("symbol", "i", np.int32),
+    ("side", "b", np.int8),
+    ("quantity", "d", np.float64),
+    ("price", "d", np.float64),
+    ("fee", "d", np.float64),
+]
+SIDES = {"buy": 1, "sell": -1}
+RUN_FILE = "run.json"
+STRINGS_FILE = "strings.json"
+
+
+class TradeLedger:
+    # One partition per run, rows are buffered and appended to the column files
+    def __init__(self, ledger_dir, kind, currency="BTC", params={}, buffer_size=65536):
+        created = datetime.datetime.now()
+        self.path = None
+        suffix = 0
+        while self.path is None:
+            run = kind + "-" + created.strftime("%Y%m%dT%H%M%S") + "-" + str(os.getpid())
+            path = os.path.join(ledger_dir, run + ("-" + str(suffix) if suffix else ""))
+            try:
+                os.makedirs(path)
+                self.path = path
+            except FileExistsError:
+                suffix += 1
+        with open(os.path.join(self.path, RUN_FILE), "w") as run_file:
+            json.dump(
+                {"kind": kind, "created": str(created), "currency": currency, "params": params},
+                run_file,
+            )
+        self.strings = []
+        self.string_ids = {}
+        self.buffer_size = buffer_size
+        self.buffers = dict((name, array(typecode)) for name, typecode, _ in COLUMNS)
+
+    def intern(self, string):
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+            with open(os.path.join(self.path, STRINGS_FILE), "w") as strings_file:
+                json.dump(self.strings, strings_file)
+        return self.string_ids[string]
+
+    def append(self, date, venue, symbol, side, quantity, price, fee=0):
+        for name, value in [
+            ("timestamp", int(date.timestamp())),
+            ("venue", self.intern(venue)),
+            ("symbol", self.intern(symbol)),
+            ("side", SIDES[side]),
+            ("quantity", quantity),
+            ("price", price),
+            ("fee", fee),
+        ]:
+            self.buffers[name].append(value)
+        if len(self.buffers["timestamp"]) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for name, _, _ in COLUMNS:
+            with open(os.path.join(self.path, name), "ab") as column_file:
+                self.buffers[name].tofile(column_file)
+            del self.buffers[name][:]
+
+    def close(self):
+        self.flush()
+
+
+def get_runs(ledger_dir):
+    if not os.path.isdir(ledger_dir):
+        return []
+    return sorted(
+        run
+        for run in os.listdir(ledger_dir)
+        if os.path.exists(os.path.join(ledger_dir, run, RUN_FILE))
+    )
+
+
+def load_run(ledger_dir, run):
+    path = os.path.join(ledger_dir, run)
+    with open(os.path.join(path, RUN_FILE)) as run_file:
+        ledger = json.load(run_file)
+    try:
+        with open(os.path.join(path, STRINGS_FILE)) as strings_file:
+            ledger["strings"] = json.load(strings_file)
+    except FileNotFoundError:
+        ledger["strings"] = []
+    columns = {}
+    for name, _, dtype in COLUMNS:
+        column_path = os.path.join(path, name)
+        columns[name] = (
+            np.fromfile(column_path, dtype=dtype)
+            if os.path.exists(column_path)
+            else np.array([], dtype=dtype)
+        )
+    # An interrupted flush may leave some columns longer than the others
+    count = min(len(column) for column in columns.values())
+    ledger["columns"] = dict((name, column[:count]) for name, column in columns.items())
+    return ledger
+
+
+def aggregate(ledger, by="symbol"):
+    columns = ledger["columns"]
+    ids = columns[by]
+    values = columns["quantity"] * columns["price"]
+    size = len(ledger["strings"])
+    trades = np.bincount(ids, minlength=size)
+    traded_values = np.bincount(ids, weights=values, minlength=size)
+    fees = np.bincount(ids, weights=columns["fee"], minlength=size)
+    bought = np.bincount(ids, weights=values * (columns["side"] > 0), minlength=size)
+    return dict(
+        (
+            ledger["strings"][i],
+            {
+                "trades": int(trades[i]),
+                "traded_value": traded_values[i],
+                "fees": fees[i],
+                "net_bought": 2 * bought[i] - traded_values[i],
+            },
+        )
+        for i in np.flatnonzero(trades)
+    )
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: cryptolio-ledger ledger_dir [run]")
+        exit(-1)
+    ledger_dir = sys.argv[1]
+    runs = get_runs(ledger_dir)
+    if len(sys.argv) > 2:
+        if sys.argv[2] not in runs:
+            print("Unknown run", sys.argv[2])
+            exit(-1)
+        ledger = load_run(ledger_dir, sys.argv[2])
+        print(ledger["kind"], ledger["created"], ledger["params"])
+        for symbol, values in sorted(
+            aggregate(ledger).items(), key=lambda item: item[1]["traded_value"], reverse=True
+        ):
+            print(
+                symbol + ":",
+                values["trades"],
+                "trades,",
+                "%.8g" % values["traded_value"],
+                ledger["currency"],
+                "traded,",
+                "%.8g" % values["net_bought"],
+                ledger["currency"],
+                "net bought,",
+                "%.8g" % values["fees"],
+                ledger["currency"],
+                "fees",
+            )
+        return
+    for run in runs:
+        ledger = load_run(ledger_dir, run)
+        columns = ledger["columns"]
+        print(
+            run + ":",
+            len(columns["timestamp"]),
+            "trades,",
+            "%.8g" % float(np.dot(columns["quantity"], columns["price"])),
+            ledger["currency"],
+            "traded,",
+            "%.8g" % float(columns["fee"].sum()),
+            ledger["currency"],
+            "fees",
+            ledger["params"] or "",
+        )
+
+
+if __name__ == "__main__":
+    main()
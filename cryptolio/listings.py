@@ -0,0 +1,156 @@
+import asyncio
+import json
+
+import aiohttp
+from lxml import html
+
+HISTORICAL_URL = "https://coinmarketcap.com/historical/{date}/"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/110.0 Safari/537.36",
+    "Accept": "text/html,application/json",
+}
+
+
+def get_usd_quote(item):
+    quote = item.get("quote", item.get("quotes"))
+    if isinstance(quote, list):
+        usd_quotes = [q for q in quote if "USD" in [q.get("name"), q.get("symbol")]]
+        quote = usd_quotes[0] if usd_quotes else quote[-1] if quote else {}
+    elif isinstance(quote, dict) and "USD" in quote:
+        quote = quote["USD"]
+    return quote or {}
+
+
+def normalize_crypto(item):
+    quote = get_usd_quote(item)
+    marketcap = quote.get("marketCap", quote.get("market_cap"))
+    price = quote.get("price")
+    if not price or marketcap is None:
+        return None
+    return {
+        "name": item["name"],
+        "symbol": item["symbol"],
+        "marketcap": float(marketcap),
+        "usd_price": float(price),
+    }
+
+
+def get_rank(item):
+    rank = item.get("cmcRank", item.get("cmc_rank", item.get("rank")))
+    try:
+        return int(rank)
+    except (TypeError, ValueError):
+        return None
+
+
+def find_listing(data):
+    # Look for the first list of cryptos in the embedded data, whatever its path
+    if isinstance(data, str):
+        if not data.startswith("{") and not data.startswith("["):
+            return None
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return None
+    if isinstance(data, list):
+        if data and all(
+            isinstance(item, dict) and "symbol" in item and ("quote" in item or "quotes" in item)
+            for item in data
+        ):
+            return data
+        children = data
+    elif isinstance(data, dict):
+        children = data.values()
+    else:
+        return None
+    for child in children:
+        listing = find_listing(child)
+        if listing:
+            return listing
+    return None
+
+
+def parse_table(tree):
+    crypto_list = []
+    tables = tree.xpath("//table/tbody")
+    if not tables:
+        return crypto_list
+    rows = tables[0]
+    for i in range(1, len(rows)):
+        items = [text for text in rows[i].itertext()]
+        if len(items) < 6 or items[5] == "--":
+            continue
+        crypto_list.append(
+            {
+                "name": items[1],
+                "symbol": items[1],
+                "marketcap": float(items[4].replace(",", "").replace("$", "")),
+                "usd_price": float(items[5].replace(",", "").replace("$", "")),
+            }
+        )
+    return crypto_list
+
+
+def parse_listing(text):
+    text = text.strip()
+    if not text:
+        return []
+    if text.startswith("{") or text.startswith("["):
+        listing = find_listing(text)
+    else:
+        tree = html.fromstring(text)
+        scripts = tree.xpath("//script[@id='__NEXT_DATA__']/text()")
+        listing = find_listing(scripts[0]) if scripts else None
+        if not listing:
+            return parse_table(tree)
+    ranked_cryptos = []
+    for item in listing or []:
+        crypto = normalize_crypto(item)
+        if crypto:
+            ranked_cryptos.append((get_rank(item), crypto))
+    # The embedded data is not always in rank order, the top cryptos selection expects it
+    ranked_cryptos.sort(
+        key=lambda ranked: (ranked[0] is None, ranked[0] or 0, -ranked[1]["marketcap"])
+    )
+    return [crypto for _, crypto in ranked_cryptos]
+
+
+class HistoricalListingFetcher:
+    def __init__(self, url=HISTORICAL_URL, concurrency=8, retries=3, timeout=30):
+        self.url = url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+
+    async def fetch_date(self, session, semaphore, date):
+        url = self.url.format(date=date.strftime("%Y%m%d"))
+        for attempt in range(self.retries):
+            try:
+                async with semaphore, session.get(url) as response:
+                    response.raise_for_status()
+                    text = await response.text()
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                if attempt == self.retries - 1:
+                    print("Unable to fetch", url, "(" + str(exc) + ")")
+                    return []
+                await asyncio.sleep(2**attempt)
+        # The same page would give the same parsing error, it is not fetched again
+        try:
+            return parse_listing(text)
+        except ValueError as exc:
+            print("Unable to parse", url, "(" + str(exc) + ")")
+            return []
+
+    async def fetch_dates(self, dates):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(headers=HEADERS, timeout=timeout) as session:
+            crypto_lists = await asyncio.gather(
+                *[self.fetch_date(session, semaphore, date) for date in dates]
+            )
+        return dict(zip(dates, crypto_lists))
+
+    def fetch(self, dates):
+        return asyncio.run(self.fetch_dates(list(dates)))
@@ -0,0 +1,63 @@
+import math
+
+
+class RiskMetrics:
+    # Online accumulators: nothing depends on the length of the backtest
+    def __init__(self, capital, periods_per_year=52):
+        self.periods_per_year = periods_per_year
+        self.balance = capital
+        self.peak = capital
+        self.max_drawdown = 0
+        self.count = 0
+        self.mean = 0
+        self.m2 = 0
+        self.rebalancings = 0
+        self.turnover = 0
+        self.fees = 0
+        self.fee_factor = 1
+
+    def update(self, balance, traded_value=0, fees=0):
+        # Welford algorithm for the mean and the variance of the returns
+        period_return = balance / self.balance - 1
+        self.count += 1
+        delta = period_return - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (period_return - self.mean)
+        self.peak = max(self.peak, balance)
+        self.max_drawdown = max(self.max_drawdown, 1 - balance / self.peak)
+        balance_before_fees = balance + fees
+        if balance_before_fees:
+            self.rebalancings += 1
+            self.turnover += traded_value / balance_before_fees / 2
+            self.fee_factor *= 1 - fees / balance_before_fees
+        self.fees += fees
+        self.balance = balance
+
+    def get_volatility(self):
+        if self.count < 2:
+            return 0
+        return math.sqrt(self.m2 / (self.count - 1) * self.periods_per_year)
+
+    def get_sharpe_ratio(self):
+        volatility = self.get_volatility()
+        if not volatility:
+            return 0
+        return self.mean * self.periods_per_year / volatility
+
+    def get_average_turnover(self):
+        if not self.rebalancings:
+            return 0
+        return self.turnover / self.rebalancings
+
+    def get_fee_drag(self):
+        return 1 - self.fee_factor
+
+    def get_summary(self):
+        return {
+            "sharpe_ratio": self.get_sharpe_ratio(),
+            "volatility": self.get_volatility(),
+            "max_drawdown": self.max_drawdown,
+            "turnover": self.get_average_turnover(),
+            "fees": self.fees,
+            "fee_drag": self.get_fee_drag(),
+        }
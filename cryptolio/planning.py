@@ -0,0 +1,726 @@
+import copy
+
+import ccxt
+import numpy as np
+
+from cryptolio.conversion import ConversionGraph
+from cryptolio.strategies import MarketcapStrategy, cap_weightings
+from cryptolio.tracker import DriftTracker
+
+COLD_WALLET = "cold wallet"
+PLANNER_SETTINGS = [
+    "manual_weightings",
+    "cold_wallet",
+    "cold_wallet_ratio",
+    "capping_level",
+    "number_of_cryptos",
+    "trading_slippage",
+    "order_netting",
+]
+precision_mode_cache = {}
+
+
+class PlanningError(Exception):
+    pass
+
+
+class Planner:
+    # Pure computation of the rebalancing: no request, no output and no exit
+    def __init__(
+        self,
+        platforms,
+        balances,
+        tickers,
+        markets,
+        crypto_listing=None,
+        precision_modes={},
+        manual_weightings={},
+        cold_wallet={},
+        cold_wallet_ratio=0.8,
+        capping_level=0.1,
+        number_of_cryptos=20,
+        trading_slippage=0.03,
+        order_netting=False,
+    ):
+        self.platforms = platforms
+        self.balances = balances
+        self.tickers = tickers
+        self.markets = markets
+        self.crypto_listing = crypto_listing
+        self.precision_modes = precision_modes
+        self.manual_weightings = manual_weightings
+        self.cold_wallet = cold_wallet
+        self.cold_wallet_ratio = cold_wallet_ratio
+        self.capping_level = capping_level
+        self.number_of_cryptos = number_of_cryptos
+        self.trading_slippage = trading_slippage
+        self.order_netting = order_netting
+        self.market_constraints = {}
+        self.conversion_graphs = {}
+        self.warnings = []
+        self.transfers = []
+
+    def get_crypto_listing(self):
+        return self.crypto_listing
+
+    def get_current_top_cryptos(self, limit=20, forced_cryptos=[], excluded_cryptos=[]):
+        crypto_list = self.get_crypto_listing()
+        top_cryptos = {}
+        selected_cryptos = []
+        for crypto in crypto_list:
+            if crypto["symbol"] in forced_cryptos:
+                selected_cryptos.append(crypto)
+            if len(selected_cryptos) == len(forced_cryptos):
+                break
+        for crypto in crypto_list:
+            if crypto["symbol"] not in forced_cryptos and crypto["symbol"] not in excluded_cryptos:
+                selected_cryptos.append(crypto)
+            if len(selected_cryptos) >= limit:
+                break
+        for crypto in selected_cryptos:
+            top_cryptos[crypto["symbol"]] = {
+                "rank": int(crypto["cmc_rank"]),
+                "name": crypto["name"],
+                "symbol": crypto["symbol"],
+                "marketcap": float(crypto["quote"]["USD"]["market_cap"]),
+                "supply": float(crypto["circulating_supply"]),
+                "percent_change_1h": float(crypto["quote"]["USD"]["percent_change_1h"]),
+                "percent_change_24h": float(crypto["quote"]["USD"]["percent_change_24h"]),
+                "percent_change_7d": float(crypto["quote"]["USD"]["percent_change_7d"]),
+                "percent_change_30d": float(crypto["quote"]["USD"]["percent_change_30d"]),
+                "percent_change_60d": float(crypto["quote"]["USD"]["percent_change_60d"]),
+                "percent_change_90d": float(crypto["quote"]["USD"]["percent_change_90d"]),
+            }
+        for crypto, support in self.get_crypto_platform_support(list(top_cryptos.keys())).items():
+            if not support:
+                raise PlanningError(
+                    crypto + " not supported. Ban it in config file or use another platform"
+                )
+        for crypto in selected_cryptos:
+            top_cryptos[crypto["symbol"]]["btc_price"] = float(
+                self.get_crypto_price(crypto["symbol"])
+            )
+        for crypto in forced_cryptos:
+            if crypto not in top_cryptos:
+                raise PlanningError(crypto + " does not exist")
+        return top_cryptos
+
+    def get_balance(self, portfolio):
+        return sum(
+            [portfolio[crypto]["btc_price"] * portfolio[crypto]["quantity"] for crypto in portfolio]
+        )
+
+    def get_conversion_graph(self, platform):
+        if platform not in self.conversion_graphs:
+            self.conversion_graphs[platform] = ConversionGraph(self.tickers[platform])
+        return self.conversion_graphs[platform]
+
+    def set_tickers(self, platform, tickers):
+        self.tickers[platform] = tickers
+        if platform in self.conversion_graphs:
+            self.conversion_graphs[platform].update_tickers(tickers)
+
+    def is_priced(self, crypto):
+        return any(
+            self.get_conversion_graph(platform).get_rate(crypto) is not None
+            for platform in self.platforms
+        )
+
+    def is_tradable(self, platform, crypto):
+        # The orders only use the */BTC markets
+        return crypto == "BTC" or crypto + "/BTC" in self.tickers[platform]
+
+    def get_untradable_balance(self, platform):
+        # Holdings priced through another market but which cannot be sold for BTC
+        balances = self.balances[platform]["total"]
+        conversion_graph = self.get_conversion_graph(platform)
+        return sum(
+            [
+                balances[crypto] * conversion_graph.get_rate(crypto)
+                for crypto in balances
+                if balances[crypto]
+                and not self.is_tradable(platform, crypto)
+                and conversion_graph.get_rate(crypto) is not None
+            ]
+        )
+
+    def get_platform_balance(self, platform):
+        # Only what can be traded against BTC is rebalanced, the rest is reported apart
+        balances = self.balances[platform]["total"]
+        conversion_graph = self.get_conversion_graph(platform)
+        balance = 0
+        for crypto in balances:
+            if not balances[crypto]:
+                continue
+            price = conversion_graph.get_rate(crypto)
+            if price is not None and self.is_tradable(platform, crypto):
+                balance += balances[crypto] * price
+            elif price is not None:
+                self.warnings.append(
+                    " ".join(
+                        [
+                            "Not rebalancing",
+                            str(balances[crypto]),
+                            crypto,
+                            "on",
+                            platform,
+                            "worth",
+                            str(balances[crypto] * price),
+                            "BTC (no BTC market)",
+                        ]
+                    )
+                )
+            else:
+                self.warnings.append(
+                    " ".join(
+                        [
+                            "Ignoring",
+                            str(balances[crypto]),
+                            crypto,
+                            "on",
+                            platform,
+                            "(no market to convert it to BTC)",
+                        ]
+                    )
+                )
+        return balance
+
+    def get_crypto_price(self, crypto, platform=None, currency="BTC"):
+        if currency not in ["BTC", "USD"]:
+            raise NotImplementedError
+        platforms = [platform] if platform else list(self.platforms)
+        prices = [
+            self.get_conversion_graph(platform).get_rate(crypto, currency) for platform in platforms
+        ]
+        prices = [price for price in prices if price is not None]
+        return sum(prices) / len(prices)
+
+    def get_total_market_cap(self, portfolio, cryptos=None):
+        if not cryptos:
+            cryptos = portfolio.keys()
+        return sum([portfolio[crypto]["marketcap"] for crypto in cryptos])
+
+    def get_ideal_portfolio(self, btc_capital):
+        forced_cryptos = [crypto for crypto, quantity in self.manual_weightings.items() if quantity]
+        excluded_cryptos = [
+            crypto for crypto, quantity in self.manual_weightings.items() if not quantity
+        ]
+        portfolio = self.get_current_top_cryptos(
+            self.number_of_cryptos, forced_cryptos, excluded_cryptos
+        )
+        weightings = cap_weightings(
+            MarketcapStrategy().get_weightings(portfolio),
+            self.capping_level,
+            self.manual_weightings,
+        )
+        for crypto, values in portfolio.items():
+            portfolio[crypto]["weighting"] = weightings[crypto]
+            portfolio[crypto]["quantity"] = btc_capital * weightings[crypto] / values["btc_price"]
+        assert abs(sum([values["weighting"] for crypto, values in portfolio.items()]) - 1) < 0.01
+        assert abs(self.get_balance(portfolio) / btc_capital - 1) < 0.01
+        return portfolio
+
+    def get_crypto_platform_support(self, cryptos):
+        platform_support = {}
+        for crypto in cryptos:
+            support = []
+            for platform in self.platforms:
+                tickers = self.tickers[platform]
+                if crypto + "/BTC" in tickers:
+                    support.append(platform)
+            platform_support[crypto] = support
+        platform_support["BTC"] = list(self.platforms)
+        return platform_support
+
+    def get_portfolio_excluding_cold_wallet(self, portfolio):
+        portfolio = copy.deepcopy(portfolio)
+        for crypto, balance in self.cold_wallet.items():
+            if not balance:
+                continue
+            portfolio[crypto]["weighting"] *= (portfolio[crypto]["quantity"] - balance) / portfolio[
+                crypto
+            ]["quantity"]
+            portfolio[crypto]["quantity"] -= balance
+        total_weightings = sum([portfolio[crypto]["weighting"] for crypto in portfolio])
+        for crypto in portfolio:
+            portfolio[crypto]["weighting"] /= total_weightings
+        assert abs(sum([portfolio[crypto]["weighting"] for crypto in portfolio]) - 1) < 0.01
+        return portfolio
+
+    def get_ideal_portfolio_per_platform(self, portfolio, platform_balances):
+        platforms = list(self.platforms)
+        cryptos = list(portfolio)
+        platform_support = self.get_crypto_platform_support(cryptos)
+        support = np.array(
+            [
+                [platform in platform_support[crypto] for crypto in cryptos]
+                for platform in platforms
+            ],
+            dtype=bool,
+        )
+        quantities = np.array([portfolio[crypto]["quantity"] for crypto in cryptos], dtype=float)
+        weightings = np.array([portfolio[crypto]["weighting"] for crypto in cryptos], dtype=float)
+        shares = np.array([platform_balances[platform] for platform in platforms], dtype=float)
+        shares /= shares.sum()
+        # Split by balance share, then spread the unsupported parts among the supporting platforms
+        split_quantities = shares[:, np.newaxis] * quantities
+        removed_quantities = np.where(support, 0, split_quantities).sum(axis=0)
+        platform_quantities = np.where(
+            support, split_quantities + removed_quantities / support.sum(axis=0), 0
+        )
+        ratios = np.divide(
+            platform_quantities,
+            split_quantities,
+            out=np.ones_like(split_quantities),
+            where=split_quantities != 0,
+        )
+        platform_weightings = np.where(support, weightings * ratios, 0)
+        capped = ~support.all(axis=0)
+        old_weightings_sum_capped = weightings[capped].sum()
+        weightings_sum_capped = np.where(capped, platform_weightings, 0).sum(axis=1)
+        # BTC from another platform or the cold wallet is needed when a platform is overweighted
+        transfers = [
+            {
+                "crypto": "BTC",
+                "quantity": float((weightings_sum - 1) * platform_balances[platform]),
+                "source": None,
+                "destination": platform,
+            }
+            for platform, weightings_sum in zip(platforms, weightings_sum_capped)
+            if weightings_sum > 1
+        ]
+        if transfers:
+            self.transfers += transfers
+            return None
+        if capped.all():
+            rescaling = np.ones(len(platforms))
+        else:
+            rescaling = (1 - weightings_sum_capped) / (1 - old_weightings_sum_capped)
+        platform_weightings = np.where(
+            capped, platform_weightings, weightings * rescaling[:, np.newaxis]
+        )
+        platform_quantities = np.where(
+            capped, platform_quantities, split_quantities * rescaling[:, np.newaxis]
+        )
+        platform_weightings /= platform_weightings.sum(axis=1, keepdims=True)
+        assert np.all(np.abs(platform_weightings.sum(axis=1) - 1) < 0.01)
+        assert np.all(platform_quantities.sum(axis=0) - quantities < 0.01)
+        portfolios = {}
+        for index, platform in enumerate(platforms):
+            portfolios[platform] = {}
+            for crypto_index in np.flatnonzero(support[index]):
+                crypto = cryptos[crypto_index]
+                portfolios[platform][crypto] = dict(
+                    portfolio[crypto],
+                    quantity=float(platform_quantities[index, crypto_index]),
+                    weighting=float(platform_weightings[index, crypto_index]),
+                )
+        return portfolios
+
+    def get_netted_portfolio_per_platform(self, portfolio, platform_balances):
+        # Holdings stay where they are: the excess of a crypto is sold where it is held the most
+        # and the missing part is bought where the most BTC is left
+        if any(values["quantity"] < 0 for values in portfolio.values()):
+            return None
+        platform_support = self.get_crypto_platform_support(list(portfolio))
+        targets = dict((platform, {}) for platform in self.platforms)
+        residuals = dict(platform_balances)
+        needs = {}
+        for crypto, values in portfolio.items():
+            if crypto == "BTC":
+                continue
+            holdings = dict(
+                (platform, self.balances[platform]["total"].get(crypto) or 0)
+                for platform in platform_support[crypto]
+            )
+            excess = max(sum(holdings.values()) - values["quantity"], 0)
+            for platform in sorted(holdings, key=lambda platform: -holdings[platform]):
+                sold = min(excess, holdings[platform])
+                excess -= sold
+                targets[platform][crypto] = holdings[platform] - sold
+                residuals[platform] -= targets[platform][crypto] * self.get_crypto_price(
+                    crypto, platform
+                )
+            needs[crypto] = values["quantity"] - sum(holdings.values()) + excess
+        # Cryptos supported by fewer platforms first, they have less BTC to choose from
+        for crypto in sorted(
+            needs,
+            key=lambda crypto: (
+                len(platform_support[crypto]),
+                -needs[crypto] * self.get_crypto_price(crypto),
+                crypto,
+            ),
+        ):
+            need = needs[crypto]
+            for relocating in [False, True]:
+                for platform in sorted(
+                    platform_support[crypto], key=lambda platform: -residuals[platform]
+                ):
+                    if need <= 0:
+                        break
+                    price = self.get_crypto_price(crypto, platform)
+                    if relocating:
+                        self.relocate_targets(
+                            targets,
+                            residuals,
+                            platform_support,
+                            platform,
+                            need * price - residuals[platform],
+                        )
+                    bought = min(need, max(residuals[platform], 0) / price)
+                    targets[platform][crypto] = targets[platform].get(crypto, 0) + bought
+                    residuals[platform] -= bought * price
+                    need -= bought
+            # Prices differ a bit between platforms, otherwise split by balance share
+            if need > portfolio[crypto]["quantity"] * 0.01:
+                return None
+        portfolios = {}
+        for platform in self.platforms:
+            targets[platform]["BTC"] = residuals[platform]
+            portfolios[platform] = {}
+            for crypto in portfolio:
+                if targets[platform].get(crypto, 0) <= 0:
+                    continue
+                portfolios[platform][crypto] = dict(
+                    portfolio[crypto],
+                    quantity=float(targets[platform][crypto]),
+                    weighting=float(
+                        targets[platform][crypto]
+                        * self.get_crypto_price(crypto, platform)
+                        / platform_balances[platform]
+                    ),
+                )
+        return portfolios
+
+    def relocate_targets(self, targets, residuals, platform_support, source, value):
+        # Free BTC on a platform by moving other cryptos to the platforms with BTC left
+        for crypto in sorted(
+            targets[source],
+            key=lambda crypto: -targets[source][crypto] * self.get_crypto_price(crypto, source),
+        ):
+            source_price = self.get_crypto_price(crypto, source)
+            for destination in sorted(
+                platform_support[crypto], key=lambda platform: -residuals[platform]
+            ):
+                if value <= 0:
+                    return
+                if destination == source or residuals[destination] <= 0:
+                    continue
+                moved = min(value, targets[source][crypto] * source_price, residuals[destination])
+                targets[source][crypto] -= moved / source_price
+                targets[destination][crypto] = targets[destination].get(
+                    crypto, 0
+                ) + moved / self.get_crypto_price(crypto, destination)
+                residuals[source] += moved
+                residuals[destination] -= moved
+                value -= moved
+
+    def get_market_constraints(self, platform):
+        if platform not in self.market_constraints:
+            # amount min, amount max, cost min, amount precision and price precision
+            constraints = {"BTC": [np.nan, np.nan, 0.001, np.nan, np.nan]}
+            for symbol, market in self.markets[platform].items():
+                if not symbol.endswith("/BTC"):
+                    continue
+                limits = market.get("limits", {})
+                precision = market.get("precision", {})
+                constraints[symbol.split("/")[0]] = [
+                    limits.get("amount", {}).get("min"),
+                    limits.get("amount", {}).get("max"),
+                    limits.get("cost", {}).get("min"),
+                    precision.get("amount"),
+                    precision.get("price"),
+                ]
+            self.market_constraints[platform] = dict(
+                (crypto, [np.nan if value is None else value for value in values])
+                for crypto, values in constraints.items()
+            )
+        return self.market_constraints[platform]
+
+    def get_deltas(self, new_balances_per_platform):
+        original_balances_per_platform = dict(
+            (
+                platform,
+                dict(
+                    (crypto, balance)
+                    for crypto, balance in self.balances[platform]["total"].items()
+                    if balance
+                ),
+            )
+            for platform in new_balances_per_platform
+        )
+        rows = [
+            (platform, crypto)
+            for platform, new_balances in new_balances_per_platform.items()
+            for crypto in sorted(set(original_balances_per_platform[platform]) | set(new_balances))
+        ]
+        platform_support = self.get_crypto_platform_support(
+            sorted(set(crypto for _, crypto in rows))
+        )
+        missing_constraints = [np.nan] * 5
+        constraints = np.array(
+            [
+                self.get_market_constraints(platform).get(crypto, missing_constraints)
+                for platform, crypto in rows
+            ],
+            dtype=float,
+        ).reshape(len(rows), 5)
+        amount_min, amount_max, cost_min, amount_precision, price_precision = constraints.T
+        precision_modes = np.array(
+            [self.precision_modes[platform] for platform, _ in rows], dtype=int
+        )
+        supported = np.array(
+            [platform in platform_support[crypto] for platform, crypto in rows], dtype=bool
+        )
+        exempted = np.array([crypto == "BTT" for _, crypto in rows], dtype=bool)
+        current = np.array(
+            [original_balances_per_platform[platform].get(crypto, 0) for platform, crypto in rows],
+            dtype=float,
+        )
+        target = np.array(
+            [new_balances_per_platform[platform].get(crypto, 0) for platform, crypto in rows],
+            dtype=float,
+        )
+        last_prices = np.array(
+            [
+                1
+                if crypto == "BTC"
+                else self.tickers[platform][crypto + "/BTC"]["last"]
+                if crypto + "/BTC" in self.tickers[platform]
+                else np.nan
+                for platform, crypto in rows
+            ],
+            dtype=float,
+        )
+        quantity_delta = target - current
+        buying = quantity_delta > 0
+        amounts = round_to_precision(
+            np.abs(quantity_delta), amount_precision, precision_modes, round_up=False
+        )
+        prices = np.where(
+            buying,
+            round_to_precision(
+                last_prices * (1 + self.trading_slippage),
+                price_precision,
+                precision_modes,
+                round_up=True,
+            ),
+            round_to_precision(
+                last_prices * (1 - self.trading_slippage),
+                price_precision,
+                precision_modes,
+                round_up=False,
+            ),
+        )
+        costs = amounts * prices
+        within_limits = ~(
+            (amounts < amount_min) | (amounts > amount_max) | (costs < cost_min) | (amounts <= 0)
+        )
+        # BTT skips the order limits but, unlike before, not the support check: without a
+        # BTT/BTC market on the platform there is no price to place its order
+        valid = supported & (exempted | within_limits)
+        deltas = {}
+        for platform in new_balances_per_platform:
+            deltas[platform] = {
+                "buy": {},
+                "sell": {},
+                "added": [],
+                "removed": [],
+                "ignored": [],
+                "orders": [],
+            }
+        for index, (platform, crypto) in enumerate(rows):
+            if quantity_delta[index] == 0:
+                continue
+            delta = deltas[platform]
+            if not valid[index]:
+                delta["ignored"].append(crypto)
+                continue
+            operation = "buy" if buying[index] else "sell"
+            delta[operation][crypto] = float(amounts[index])
+            if crypto not in original_balances_per_platform[platform]:
+                delta["added"].append(crypto)
+            if crypto not in new_balances_per_platform[platform]:
+                delta["removed"].append(crypto)
+            if crypto != "BTC":
+                delta["orders"].append(
+                    {
+                        "symbol": crypto + "/BTC",
+                        "crypto": crypto,
+                        "side": operation,
+                        "amount": float(amounts[index]),
+                        "price": float(prices[index]),
+                        "cost": float(costs[index]),
+                    }
+                )
+        # Sell first to get the BTC needed by the buy orders
+        for delta in deltas.values():
+            delta["orders"].sort(key=lambda order: (order["side"] == "buy", -order["cost"]))
+        return deltas
+
+    def get_cold_wallet_capital(self):
+        for crypto, support in self.get_crypto_platform_support(
+            list(self.cold_wallet.keys())
+        ).items():
+            if crypto != "BTC" and self.cold_wallet[crypto] and not support:
+                raise PlanningError(crypto + " not supported. Remove it from cold wallet")
+        return sum(
+            [
+                quantity * self.get_crypto_price(crypto)
+                for crypto, quantity in self.cold_wallet.items()
+                if quantity
+            ]
+        )
+
+    def get_drift_tracker(self, ideal_portfolio, drift_band=0.2, on_drift=None):
+        quantities = {}
+        for platform in self.platforms:
+            conversion_graph = self.get_conversion_graph(platform)
+            for crypto, quantity in self.balances[platform]["total"].items():
+                if (
+                    quantity
+                    and conversion_graph.get_rate(crypto) is not None
+                    and self.is_tradable(platform, crypto)
+                ):
+                    quantities[crypto] = quantities.get(crypto, 0) + quantity
+        for crypto, quantity in self.cold_wallet.items():
+            if quantity:
+                quantities[crypto] = quantities.get(crypto, 0) + quantity
+        prices = dict(
+            (crypto, self.get_crypto_price(crypto))
+            for crypto in set(quantities) | set(ideal_portfolio)
+        )
+        targets = dict((crypto, values["weighting"]) for crypto, values in ideal_portfolio.items())
+        return DriftTracker(quantities, prices, targets, drift_band, on_drift)
+
+    def plan(self):
+        self.warnings = []
+        self.transfers = []
+        platform_balances = dict(
+            (platform, self.get_platform_balance(platform)) for platform in self.platforms
+        )
+        cold_capital = self.get_cold_wallet_capital()
+        capital = sum(platform_balances.values()) + cold_capital
+        ideal_portfolio = self.get_ideal_portfolio(capital)
+        plan = {
+            "capital": capital,
+            "platform_balances": platform_balances,
+            "untradable_balances": dict(
+                (platform, self.get_untradable_balance(platform)) for platform in self.platforms
+            ),
+            "cold_capital": cold_capital,
+            "ideal_portfolio": ideal_portfolio,
+            "portfolios": None,
+            "deltas": None,
+            "transfers": self.transfers,
+            "warnings": self.warnings,
+        }
+        for crypto, cold_balance in self.cold_wallet.items():
+            if crypto not in ideal_portfolio and cold_balance:
+                self.transfers.append(
+                    {
+                        "crypto": crypto,
+                        "quantity": cold_balance,
+                        "source": COLD_WALLET,
+                        "destination": None,
+                    }
+                )
+        if self.transfers:
+            return plan
+        online_ideal_portfolio = self.get_portfolio_excluding_cold_wallet(ideal_portfolio)
+        portfolios = None
+        if self.order_netting:
+            portfolios = self.get_netted_portfolio_per_platform(
+                online_ideal_portfolio, platform_balances
+            )
+        if portfolios is None:
+            portfolios = self.get_ideal_portfolio_per_platform(
+                online_ideal_portfolio, platform_balances
+            )
+        if portfolios is None:
+            return plan
+        for platform, portfolio in portfolios.items():
+            for crypto in portfolio:
+                if portfolio[crypto]["quantity"] < 0:
+                    self.transfers.append(
+                        {
+                            "crypto": crypto,
+                            "quantity": abs(portfolio[crypto]["quantity"]),
+                            "source": COLD_WALLET,
+                            "destination": platform,
+                        }
+                    )
+        if self.transfers:
+            return plan
+        plan["portfolios"] = portfolios
+        plan["deltas"] = self.get_deltas(
+            dict(
+                (
+                    platform,
+                    dict((crypto, values["quantity"]) for crypto, values in portfolio.items()),
+                )
+                for platform, portfolio in portfolios.items()
+            )
+        )
+        return plan
+
+
+def round_to_precision(values, precisions, precision_modes, round_up=False):
+    # Values without known precision are left untouched
+    magnitudes = np.floor(np.log10(np.abs(np.where(values > 0, values, 1))))
+    steps = np.select(
+        [precision_modes == ccxt.TICK_SIZE, precision_modes == ccxt.SIGNIFICANT_DIGITS],
+        [precisions, 10.0 ** (magnitudes - precisions + 1)],
+        10.0**-precisions,
+    )
+    if round_up:
+        steps_count = np.ceil(values / steps - 1e-9)
+    else:
+        steps_count = np.floor(values / steps + 1e-9)
+    # Divide by the inverse step when possible to get the closest float to the decimal value
+    inverse_steps = np.round(1 / steps)
+    exact = np.abs(inverse_steps * steps - 1) < 1e-9
+    rounded = np.where(exact, steps_count / np.where(exact, inverse_steps, 1), steps_count * steps)
+    return np.where(np.isnan(steps), values, rounded)
+
+
+def get_precision_mode(platform):
+    # Only depends on the exchange class, creating a client does not send any request
+    if platform not in precision_mode_cache:
+        precision_mode_cache[platform] = getattr(ccxt, platform)().precisionMode
+    return precision_mode_cache[platform]
+
+
+class MarketSnapshot:
+    # Scenarios planned on the same market data share its conversion graphs and constraints
+    def __init__(self, tickers, markets, listings, precision_modes=None):
+        self.tickers = tickers
+        self.markets = markets
+        self.listings = listings
+        self.precision_modes = dict(precision_modes or {})
+        self.conversion_graphs = {}
+        self.market_constraints = {}
+
+    def plan(self, balances, settings={}):
+        platforms = list(balances)
+        for platform in platforms:
+            if platform not in self.precision_modes:
+                self.precision_modes[platform] = get_precision_mode(platform)
+        planner = Planner(
+            platforms,
+            balances,
+            self.tickers,
+            self.markets,
+            self.listings,
+            self.precision_modes,
+            **dict((key, settings[key]) for key in PLANNER_SETTINGS if key in settings)
+        )
+        # Both only depend on the tickers and markets, built by the first scenario needing them
+        planner.conversion_graphs = self.conversion_graphs
+        planner.market_constraints = self.market_constraints
+        return planner.plan()
+
+
+def plan_rebalance(balances, tickers, markets, listings, settings={}):
+    snapshot = MarketSnapshot(tickers, markets, listings, settings.get("precision_modes"))
+    return snapshot.plan(balances, settings)
@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 
 import configparser
-import copy
-import json
+import contextlib
+import datetime
+import os
 import sys
 import time
-import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import ccxt
 import click
+import numpy as np
 from coinmarketcapapi import CoinMarketCapAPI
 
+from cryptolio.cache import CACHE_FORMATS, SnapshotCache
+from cryptolio.ledger import TradeLedger
+from cryptolio.listings import normalize_crypto
+from cryptolio.planning import Planner, PlanningError, round_to_precision
+from cryptolio.scheduler import RequestScheduler
+from cryptolio.tokens import TokenRegistry
 
-class PortfolioManager:
+
+class PortfolioManager(Planner):
     def __init__(
         self,
         coinmarketcap_api_key,
@@ -23,235 +32,104 @@ class PortfolioManager:
         capping_level=0.1,
         number_of_cryptos=20,
         trading_slippage=0.03,
+        order_netting=False,
+        rate_limits={},
+        crypto_listing=None,
+        tickers={},
+        markets={},
+        exchanges={},
+        order_poll_interval=0.5,
+        ledger_dir=None,
+        order_book_pricing=True,
+        order_book_depth=20,
+        order_book_max_age=10,
+        token_registry_file=None,
+        token_registry_max_age=7,
     ):
         self.coinmarketcap_api_key = coinmarketcap_api_key
-        self.manual_weightings = manual_weightings
-        self.cold_wallet = cold_wallet
-        self.cold_wallet_ratio = cold_wallet_ratio
-        self.capping_level = capping_level
-        self.number_of_cryptos = number_of_cryptos
-        self.trading_slippage = trading_slippage
+        self.order_poll_interval = order_poll_interval
+        self.order_book_pricing = order_book_pricing
+        self.order_book_depth = order_book_depth
+        self.order_book_max_age = order_book_max_age
+        self.order_books = {}
+        self.token_registry = TokenRegistry(token_registry_file, token_registry_max_age)
+        self.ledger_dir = ledger_dir
+        self.ledger = None
+        self.scheduler = RequestScheduler(rate_limits)
         self.platforms = {}
+        # Prebuilt exchanges, like the simulated ones, are used as is
+        for platform, exchange in exchanges.items():
+            self.platforms[platform] = self.scheduler.register(platform, exchange)
         for platform in api_keys:
             class_name = getattr(ccxt, platform)
             args = {"apiKey": api_keys[platform]["api_key"], "secret": api_keys[platform]["secret"]}
             if platform == "kucoin":
                 args["password"] = api_keys[platform]["password"]
-            self.platforms[platform] = class_name(args)
-        self.balances = {}
-        self.tickers = {}
-        self.markets = {}
-        for platform in self.platforms:
-            self.balances[platform] = self.platforms[platform].fetch_balance()
-            self.tickers[platform] = self.platforms[platform].fetch_tickers()
-            self.markets[platform] = self.platforms[platform].load_markets()
-
-    def get_current_top_cryptos(self, limit=20, forced_cryptos=[], excluded_cryptos=[]):
-        coinmarketcap = CoinMarketCapAPI(self.coinmarketcap_api_key, sandbox=False)
-        crypto_list = coinmarketcap.cryptocurrency_listings_latest(limit=1000).data
-        top_cryptos = {}
-        selected_cryptos = []
-        for crypto in crypto_list:
-            if crypto["symbol"] in forced_cryptos:
-                selected_cryptos.append(crypto)
-            if len(selected_cryptos) == len(forced_cryptos):
-                break
-        for crypto in crypto_list:
-            if crypto["symbol"] not in forced_cryptos and crypto["symbol"] not in excluded_cryptos:
-                selected_cryptos.append(crypto)
-            if len(selected_cryptos) >= limit:
-                break
-        for crypto in selected_cryptos:
-            top_cryptos[crypto["symbol"]] = {
-                "rank": int(crypto["cmc_rank"]),
-                "name": crypto["name"],
-                "symbol": crypto["symbol"],
-                "marketcap": float(crypto["quote"]["USD"]["market_cap"]),
-                "supply": float(crypto["circulating_supply"]),
-                "percent_change_1h": float(crypto["quote"]["USD"]["percent_change_1h"]),
-                "percent_change_24h": float(crypto["quote"]["USD"]["percent_change_24h"]),
-                "percent_change_7d": float(crypto["quote"]["USD"]["percent_change_7d"]),
-                "percent_change_30d": float(crypto["quote"]["USD"]["percent_change_30d"]),
-                "percent_change_60d": float(crypto["quote"]["USD"]["percent_change_60d"]),
-                "percent_change_90d": float(crypto["quote"]["USD"]["percent_change_90d"]),
-            }
-        for crypto, support in self.get_crypto_platform_support(list(top_cryptos.keys())).items():
-            if not support:
-                print(crypto, "not supported. Ban it in config file or use another platform")
-                exit(-1)
-        for crypto in selected_cryptos:
-            top_cryptos[crypto["symbol"]]["btc_price"] = float(
-                self.get_crypto_price(crypto["symbol"])
-            )
-        for crypto in forced_cryptos:
-            if crypto not in top_cryptos:
-                print(crypto, "does not exist")
-                exit(-1)
-        return top_cryptos
-
-    def get_balance(self, portfolio):
-        return sum(
-            [portfolio[crypto]["btc_price"] * portfolio[crypto]["quantity"] for crypto in portfolio]
+            self.platforms[platform] = self.scheduler.register(platform, class_name(args))
+        balances = {}
+        tickers = dict(
+            (platform, tickers[platform]) for platform in self.platforms if platform in tickers
         )
-
-    def get_platform_balance(self, platform):
-        balances = self.balances[platform]["total"]
-        tickers = self.tickers[platform]
-        balance = 0
-        for crypto in balances:
-            if not balances[crypto]:
-                continue
-            if crypto + "/BTC" in tickers or crypto == "BTC":
-                price = tickers[crypto + "/BTC"]["last"] if crypto != "BTC" else 1
-                balance += balances[crypto] * price
-            else:
-                print(
-                    "Ignoring",
-                    balances[crypto],
-                    crypto,
-                    "on",
+        markets = dict(
+            (platform, markets[platform]) for platform in self.platforms if platform in markets
+        )
+        with ThreadPoolExecutor() as executor:
+            futures = dict(
+                (
                     platform,
-                    "(not available in BTC market)",
+                    [
+                        executor.submit(self.scheduler.call, platform, "fetch_balance"),
+                        None
+                        if platform in tickers
+                        else executor.submit(self.scheduler.call, platform, "fetch_tickers"),
+                        None
+                        if platform in markets
+                        else executor.submit(self.scheduler.call, platform, "load_markets"),
+                    ],
                 )
-        return balance
-
-    def get_crypto_price(self, crypto, platform=None, currency="BTC"):
-        platforms = [platform] if platform else list(self.platforms.keys())
-        prices = []
-        supported_platforms = 0
-        for platform in platforms:
-            if crypto == "BTC":
-                prices.append(1)
-                supported_platforms += 1
-            elif crypto + "/BTC" in self.tickers[platform]:
-                prices.append(self.tickers[platform][crypto + "/BTC"]["last"])
-                supported_platforms += 1
-        if currency == "USD":
-            btc_prices = [
-                self.tickers[platform]["BTC/USDT"]["last"]
-                for platform in platforms
-                if "BTC/USDT" in self.tickers[platform]
-            ]
-            btc_price = sum(btc_prices) / len(btc_prices)
-            return sum(prices) / supported_platforms * btc_price
-        elif currency == "BTC":
-            return sum(prices) / supported_platforms
-        else:
-            raise NotImplementedError
-
-    def get_total_market_cap(self, portfolio, cryptos=None):
-        if not cryptos:
-            cryptos = portfolio.keys()
-        return sum([portfolio[crypto]["marketcap"] for crypto in cryptos])
-
-    def get_uncapped_cryptos(self, portfolio):
-        precision_error = 0.001
-        uncapped_cryptos = []
-        fixed_manual_weightings = {}
-        for crypto, weighting in self.manual_weightings.items():
-            if weighting not in ["auto", 0]:
-                fixed_manual_weightings[crypto] = weighting
-        for crypto, value in portfolio.items():
-            if (
-                crypto not in fixed_manual_weightings
-                and value["weighting"] > self.capping_level + precision_error
-            ) or (
-                crypto in fixed_manual_weightings
-                and abs(value["weighting"] - fixed_manual_weightings[crypto]) > precision_error
-            ):
-                uncapped_cryptos.append(crypto)
-        return sorted(uncapped_cryptos)
-
-    def get_ideal_portfolio(self, btc_capital):
-        forced_cryptos = [crypto for crypto, quantity in self.manual_weightings.items() if quantity]
-        excluded_cryptos = [
-            crypto for crypto, quantity in self.manual_weightings.items() if not quantity
-        ]
-        portfolio = self.get_current_top_cryptos(
-            self.number_of_cryptos, forced_cryptos, excluded_cryptos
-        )
-        total_market_cap = self.get_total_market_cap(portfolio)
-        for crypto, values in portfolio.items():
-            weighting = values["marketcap"] / total_market_cap
-            portfolio[crypto]["weighting"] = weighting
-            portfolio[crypto]["quantity"] = btc_capital * weighting / values["btc_price"]
-        capped_cryptos = []
-        uncapped_cryptos = True
-        while uncapped_cryptos:
-            uncapped_cryptos = self.get_uncapped_cryptos(portfolio)
-            for crypto in uncapped_cryptos:
-                old_weighting = portfolio[crypto]["weighting"]
-                if crypto in self.manual_weightings and self.manual_weightings[crypto] not in [
-                    "auto",
-                    0,
-                ]:
-                    capping_level = self.manual_weightings[crypto]
-                else:
-                    capping_level = self.capping_level
-                portfolio[crypto]["weighting"] = capping_level
-                portfolio[crypto]["quantity"] *= capping_level / old_weighting
-                capped_cryptos.append(crypto)
-            weightings_sum_not_capped = sum(
-                [portfolio[key]["weighting"] for key in portfolio if key not in capped_cryptos]
+                for platform in self.platforms
             )
-            weightings_sum_capped = sum(
-                [portfolio[key]["weighting"] for key in portfolio if key in capped_cryptos]
-            )
-            for crypto in portfolio:
-                if crypto not in capped_cryptos:
-                    old_weighting = portfolio[crypto]["weighting"]
-                    new_weighting = (
-                        old_weighting * (1 - weightings_sum_capped) / weightings_sum_not_capped
-                    )
-                    portfolio[crypto]["weighting"] = new_weighting
-                    portfolio[crypto]["quantity"] *= new_weighting / old_weighting
-        assert abs(sum([values["weighting"] for crypto, values in portfolio.items()]) - 1) < 0.01
-        assert abs(self.get_balance(portfolio) / btc_capital - 1) < 0.01
-        return portfolio
-
-    def get_crypto_platform_support(self, cryptos):
-        platform_support = {}
-        for crypto in cryptos:
-            support = []
-            for platform in self.platforms:
-                tickers = self.tickers[platform]
-                if crypto + "/BTC" in tickers:
-                    support.append(platform)
-            platform_support[crypto] = support
-        platform_support["BTC"] = list(self.platforms.keys())
-        return platform_support
-
-    def get_portfolio_excluding_cold_wallet(self, portfolio):
-        portfolio = copy.deepcopy(portfolio)
-        for crypto, balance in self.cold_wallet.items():
-            if not balance:
-                continue
-            portfolio[crypto]["weighting"] *= (portfolio[crypto]["quantity"] - balance) / portfolio[
-                crypto
-            ]["quantity"]
-            portfolio[crypto]["quantity"] -= balance
-        total_weightings = sum([portfolio[crypto]["weighting"] for crypto in portfolio])
-        for crypto in portfolio:
-            portfolio[crypto]["weighting"] /= total_weightings
-        assert abs(sum([portfolio[crypto]["weighting"] for crypto in portfolio]) - 1) < 0.01
-        return portfolio
+        for platform, (balance, platform_tickers, platform_markets) in futures.items():
+            balances[platform] = balance.result()
+            if platform_tickers:
+                tickers[platform] = platform_tickers.result()
+            if platform_markets:
+                markets[platform] = platform_markets.result()
+        super().__init__(
+            self.platforms,
+            balances,
+            tickers,
+            markets,
+            crypto_listing,
+            dict(
+                (platform, exchange.precisionMode) for platform, exchange in self.platforms.items()
+            ),
+            manual_weightings,
+            cold_wallet,
+            cold_wallet_ratio,
+            capping_level,
+            number_of_cryptos,
+            trading_slippage,
+            order_netting,
+        )
+
+    def get_crypto_listing(self):
+        if self.crypto_listing is None:
+            self.crypto_listing = get_crypto_listing(self.coinmarketcap_api_key)
+        return self.crypto_listing
 
     def download_to_cold_wallet(self, ideal_portfolio):
-        with urllib.request.urlopen(
-            "https://raw.githubusercontent.com/kvhnuke/etherwallet/mercury/app/scripts/tokens/ethTokens.json"
-        ) as url:
-            for token in json.loads(url.read().decode()):
-                if token["symbol"] not in self.cold_wallet:
-                    self.cold_wallet[token["symbol"]] = 0
         for crypto in ideal_portfolio:
-            if crypto not in self.cold_wallet:
+            # Registry tokens are supported by the cold wallet without holding any balance
+            if crypto not in self.cold_wallet and not self.token_registry.supports(crypto):
                 continue
-            actual_ratio = self.cold_wallet[crypto] / ideal_portfolio[crypto]["quantity"]
+            cold_quantity = self.cold_wallet.get(crypto, 0)
+            actual_ratio = cold_quantity / ideal_portfolio[crypto]["quantity"]
             if actual_ratio < self.cold_wallet_ratio:
                 ideal_cold_quantity = ideal_portfolio[crypto]["quantity"] * self.cold_wallet_ratio
                 print(
                     "Transfer",
-                    ideal_cold_quantity - self.cold_wallet[crypto],
+                    ideal_cold_quantity - cold_quantity,
                     crypto,
                     "to cold wallet ("
                     + str(round(actual_ratio * 100, 2))
@@ -260,231 +138,261 @@ class PortfolioManager:
                     + "%)",
                 )
 
-    def get_ideal_portfolio_per_platform(self, portfolio, platform_balances):
-        portfolios = {}
-        for platform in self.platforms:
-            splitted_portfolio = copy.deepcopy(portfolio)
-            for crypto in splitted_portfolio:
-                splitted_portfolio[crypto]["quantity"] *= platform_balances[platform] / sum(
-                    platform_balances.values()
-                )
-            portfolios[platform] = splitted_portfolio
-        platform_support = self.get_crypto_platform_support(list(portfolio.keys()))
-        capped_cryptos = []
-        for crypto in sorted(platform_support, key=lambda crypto: len(platform_support[crypto])):
-            removed_quantity = 0
-            for platform in self.platforms:
-                if platform not in platform_support[crypto]:
-                    removed_quantity += portfolios[platform][crypto]["quantity"]
-                    del portfolios[platform][crypto]
-                    if crypto not in capped_cryptos:
-                        capped_cryptos.append(crypto)
-            for platform in self.platforms:
-                if platform in platform_support[crypto]:
-                    old_quantity = portfolios[platform][crypto]["quantity"]
-                    portfolios[platform][crypto]["quantity"] += removed_quantity / len(
-                        platform_support[crypto]
-                    )
-                    portfolios[platform][crypto]["weighting"] *= (
-                        portfolios[platform][crypto]["quantity"] / old_quantity
-                    )
-        for platform, platform_portfolio in portfolios.items():
-            old_weightings_sum_capped = sum(
-                [portfolio[crypto]["weighting"] for crypto in portfolio if crypto in capped_cryptos]
-            )
-            weightings_sum_capped = sum(
-                [
-                    platform_portfolio[crypto]["weighting"]
-                    for crypto in platform_portfolio
-                    if crypto in capped_cryptos
-                ]
+    def record_trade(self, platform, order, trade):
+        # Only what was actually filled is recorded, at the average price when known
+        if not self.ledger_dir:
+            return
+        if not self.ledger:
+            self.ledger = TradeLedger(self.ledger_dir, "rebalance")
+        quantity = order["amount"] if trade.get("filled") is None else trade["filled"]
+        if not quantity:
+            return
+        fee = trade.get("fee") or {}
+        # Fees paid in another currency (like BNB) are not converted
+        fee = (fee.get("cost") or 0) if fee.get("currency") in [None, "BTC"] else 0
+        self.ledger.append(
+            datetime.datetime.now(),
+            platform,
+            order["crypto"],
+            order["side"],
+            quantity,
+            trade.get("average") or order["price"],
+            fee,
+        )
+        self.ledger.flush()
+
+    def fetch_order_books(self, platform, symbols):
+        # Only the missing and stale books are fetched, in a single request when supported
+        books = self.order_books.setdefault(platform, {})
+        now = time.monotonic()
+        symbols = sorted(
+            set(
+                symbol
+                for symbol in symbols
+                if symbol not in books or now - books[symbol][0] > self.order_book_max_age
             )
-            if weightings_sum_capped > 1:
-                print(
-                    "Transfert",
-                    (weightings_sum_capped - 1) * platform_balances[platform],
-                    "BTC from another platform or cold wallet to",
-                    platform,
+        )
+        if not symbols:
+            return
+        fetched = {}
+        if getattr(self.platforms[platform], "has", {}).get("fetchOrderBooks"):
+            try:
+                fetched = self.scheduler.call(
+                    platform, "fetch_order_books", symbols, self.order_book_depth
                 )
-                exit(-1)
-            assert weightings_sum_capped <= 1
-            for crypto in platform_portfolio:
-                if crypto not in capped_cryptos:
-                    old_weighting = portfolio[crypto]["weighting"]
-                    new_weighting = (
-                        old_weighting
-                        * (1 - weightings_sum_capped)
-                        / (1 - old_weightings_sum_capped)
+            except Exception:
+                fetched = {}
+        missing = [symbol for symbol in symbols if symbol not in fetched]
+        if missing:
+            with ThreadPoolExecutor() as executor:
+                futures = dict(
+                    (
+                        symbol,
+                        executor.submit(
+                            self.scheduler.call,
+                            platform,
+                            "fetch_order_book",
+                            symbol,
+                            self.order_book_depth,
+                        ),
                     )
-                    platform_portfolio[crypto]["weighting"] = new_weighting
-                    platform_portfolio[crypto]["quantity"] *= new_weighting / old_weighting
-        for platform_portfolio in portfolios.values():
-            total_weightings = sum(
-                [platform_portfolio[crypto]["weighting"] for crypto in platform_portfolio]
-            )
-            for crypto in platform_portfolio:
-                platform_portfolio[crypto]["weighting"] /= total_weightings
-            assert (
-                abs(
-                    sum([platform_portfolio[crypto]["weighting"] for crypto in platform_portfolio])
-                    - 1
+                    for symbol in missing
                 )
-                < 0.01
-            )
-        for crypto in portfolio:
-            quantity = 0
-            for platform_portfolio in portfolios.values():
-                if crypto in platform_portfolio:
-                    quantity += platform_portfolio[crypto]["quantity"]
-            assert (quantity - portfolio[crypto]["quantity"]) < 0.01
-        return portfolios
-
-    def get_delta(self, platform, new_balances):
-        original_balances = self.balances[platform]["total"]
-        original_balances = dict(
-            (crypto, balance) for crypto, balance in original_balances.items() if balance
-        )
-        buy = {}
-        sell = {}
-        added_cryptos = [crypto for crypto in new_balances if crypto not in list(original_balances)]
-        common_cryptos = [
-            crypto for crypto in list(new_balances) if crypto not in added_cryptos and crypto
-        ]
-        removed_cryptos = [
-            crypto for crypto in original_balances if crypto not in list(new_balances)
+            for symbol, future in futures.items():
+                try:
+                    fetched[symbol] = future.result()
+                except Exception as exc:
+                    print("Unable to fetch", symbol, "order book (" + str(exc) + ")")
+        now = time.monotonic()
+        for symbol in symbols:
+            if symbol in fetched:
+                books[symbol] = (now, fetched[symbol])
+
+    def get_order_price(self, platform, order):
+        # Price reaching the book depth needed by the amount, bounded by the trading slippage
+        if order["symbol"] not in self.order_books.get(platform, {}):
+            return order["price"]
+        book = self.order_books[platform][order["symbol"]][1]
+        if not book["bids"] or not book["asks"]:
+            return order["price"]
+        price = get_book_price(book, order["side"], order["amount"])
+        mid_price = (book["bids"][0][0] + book["asks"][0][0]) / 2
+        if order["side"] == "buy":
+            price = min(price or np.inf, mid_price * (1 + self.trading_slippage))
+        else:
+            price = max(price or 0, mid_price * (1 - self.trading_slippage))
+        price_precision = self.get_market_constraints(platform).get(order["crypto"], [np.nan] * 5)[
+            4
         ]
-        for crypto in sorted(added_cryptos):
-            buy[crypto] = new_balances[crypto]
-        for crypto in sorted(common_cryptos):
-            quantity_delta = new_balances[crypto] - original_balances[crypto]
-            if quantity_delta > 0:
-                buy[crypto] = quantity_delta
-            elif quantity_delta < 0:
-                sell[crypto] = abs(quantity_delta)
-        for crypto in sorted(removed_cryptos):
-            sell[crypto] = original_balances[crypto]
-        platform_support = self.get_crypto_platform_support(
-            list(original_balances) + list(new_balances)
+        return float(
+            round_to_precision(
+                np.array([price]),
+                np.array([price_precision], dtype=float),
+                np.array([self.precision_modes[platform]]),
+                round_up=order["side"] == "buy",
+            )[0]
         )
-        ignored = []
-        delete = []
-        for item in [buy, sell]:
-            for crypto, quantity in item.items():
-                if crypto == "BTT":
-                    continue
-                if platform not in platform_support[crypto]:
-                    delete.append(crypto)
-                    continue
-                elif crypto == "BTC":
-                    limits = {"cost": {"min": 0.001, "max": None}}
-                else:
-                    limits = self.markets[platform][crypto + "/BTC"]["limits"]
-                if (
-                    "amount" in limits
-                    and quantity < limits["amount"]["min"]
-                    or "cost" in limits
-                    and quantity * self.get_crypto_price(crypto, platform) < limits["cost"]["min"]
-                ):
-                    delete.append(crypto)
-            for crypto in delete:
-                del item[crypto]
-                if crypto in added_cryptos:
-                    added_cryptos.remove(crypto)
-                if crypto in removed_cryptos:
-                    removed_cryptos.remove(crypto)
-            ignored += delete
-            delete = []
-        return {
-            "buy": buy,
-            "sell": sell,
-            "added": sorted(added_cryptos),
-            "removed": sorted(removed_cryptos),
-            "ignored": ignored,
-        }
 
     def apply_delta(self, platform, delta):
-        for operation in ["sell", "buy"]:
-            if operation == "sell":
-                trade_function = self.platforms[platform].create_limit_sell_order
-                factor = 1 - self.trading_slippage
-            else:
-                trade_function = self.platforms[platform].create_limit_buy_order
-                factor = 1 + self.trading_slippage
-            for crypto, quantity in delta[operation].items():
-                if crypto == "BTC":
+        if self.order_book_pricing:
+            self.fetch_order_books(platform, [order["symbol"] for order in delta["orders"]])
+        for index, order in enumerate(delta["orders"]):
+            if self.order_book_pricing:
+                # Books getting old during the execution are refreshed together
+                self.fetch_order_books(
+                    platform, [order["symbol"] for order in delta["orders"][index:]]
+                )
+                order = dict(order, price=self.get_order_price(platform, order))
+                order["cost"] = order["amount"] * order["price"]
+                # The planned cost was checked at the last price, the book price can be lower
+                constraints = self.get_market_constraints(platform)
+                cost_min = constraints.get(order["crypto"], [np.nan] * 5)[2]
+                if order["crypto"] != "BTT" and order["cost"] < cost_min:
+                    print(
+                        order["side"].capitalize(),
+                        order["amount"],
+                        order["crypto"],
+                        "skipped, its cost at",
+                        order["price"],
+                        "BTC is below the platform minimum of",
+                        cost_min,
+                        "BTC",
+                    )
                     continue
-                price = self.tickers[platform][crypto + "/BTC"]["last"] * factor
-                print(operation.capitalize(), quantity, crypto, "at", price, "BTC")
-                print("Processing", end="", flush=True)
+            if order["side"] == "sell":
+                endpoint = "create_limit_sell_order"
+            else:
+                endpoint = "create_limit_buy_order"
+            print(
+                order["side"].capitalize(),
+                order["amount"],
+                order["crypto"],
+                "at",
+                order["price"],
+                "BTC",
+            )
+            print("Processing", end="", flush=True)
+            try:
+                trade = self.scheduler.call(
+                    platform, endpoint, order["symbol"], order["amount"], order["price"]
+                )
+            except Exception as exc:
+                print(" FAILED:", str(exc))
+                continue
+            while True:
+                time.sleep(self.order_poll_interval)
                 try:
-                    trade = trade_function(crypto + "/BTC", quantity, price)
-                except Exception as exc:
-                    print(" FAILED:", str(exc))
-                    continue
-                while True:
-                    time.sleep(0.5)
-                    try:
-                        order = self.platforms[platform].fetch_order(
-                            trade["id"], symbol=crypto + "/BTC"
-                        )
-                    except Exception:
-                        print(
-                            "... order monitoring not supported. Waiting 5 seconds for completion.",
-                            end="",
-                            flush=True,
-                        )
-                        time.sleep(5)
+                    trade = self.scheduler.call(
+                        platform, "fetch_order", trade["id"], symbol=order["symbol"]
+                    )
+                except Exception:
+                    print(
+                        "... order monitoring not supported. Waiting 5 seconds for completion.",
+                        end="",
+                        flush=True,
+                    )
+                    time.sleep(5)
+                    break
+                else:
+                    if trade["status"] in ["closed", "FILLED"]:
                         break
                     else:
-                        if order["status"] in ["closed", "FILLED"]:
-                            break
-                        else:
-                            print(".", end="", flush=True)
-                print(" DONE!")
+                        print(".", end="", flush=True)
+            self.record_trade(platform, order, trade)
+            print(" DONE!")
 
-    def rebalance(self, ask_confirmation=True):
-        print("########## Balances ##########")
-        platform_balances = {}
-        for platform in self.platforms:
-            balance = self.get_platform_balance(platform)
-            platform_balances[platform] = balance
+    def watch(self, drift_band=0.2, monitor_interval=60, after_rebalance=False):
+        try:
+            plan = self.plan()
+        except PlanningError as exc:
+            print(exc)
+            return None
+        tracker = self.get_drift_tracker(plan["ideal_portfolio"], drift_band)
+        event = tracker.check()
+        if event and after_rebalance:
+            # Skipped orders can leave a drift, only trigger again once back inside the band
             print(
-                platform.capitalize(),
-                balance,
-                "BTC",
-                balance * self.get_crypto_price("BTC", currency="USD"),
-                "USD",
+                "Drift still",
+                str(round(event["drift"] * 100, 2)) + "% on",
+                event["crypto"],
+                "after the rebalancing, waiting for it to come back inside the band",
             )
-        capital = sum(platform_balances.values())
-        for crypto, support in self.get_crypto_platform_support(
-            list(self.cold_wallet.keys())
-        ).items():
-            if crypto != "BTC" and self.cold_wallet[crypto] and not support:
-                print(crypto, "not supported. Remove it from cold wallet")
-                exit(-1)
-        for crypto, quantity in self.cold_wallet.items():
-            if not quantity:
+            event = None
+        elif not event:
+            crypto, drift = tracker.get_max_drift()
+            print("Watching drift, currently", str(round(drift * 100, 2)) + "% on", crypto)
+        while not event:
+            time.sleep(monitor_interval)
+            with ThreadPoolExecutor() as executor:
+                futures = dict(
+                    (platform, executor.submit(self.scheduler.call, platform, "fetch_tickers"))
+                    for platform in self.platforms
+                )
+            try:
+                for platform, future in futures.items():
+                    self.set_tickers(platform, future.result())
+            except ccxt.NetworkError as exc:
+                print("Unable to fetch tickers (" + str(exc) + ")")
                 continue
-            capital += quantity * self.get_crypto_price(crypto)
+            # Only the cryptos whose price changed are revalued
+            for crypto in tracker.prices:
+                if not self.is_priced(crypto):
+                    continue
+                price = self.get_crypto_price(crypto)
+                if price != tracker.prices[crypto]:
+                    event = tracker.update_price(crypto, price)
+                    if event:
+                        break
         print(
-            "Cold",
-            capital - sum(platform_balances.values()),
-            "BTC",
-            (capital - sum(platform_balances.values()))
-            * self.get_crypto_price("BTC", currency="USD"),
-            "USD",
+            "Drift of",
+            str(round(event["drift"] * 100, 2)) + "% on",
+            event["crypto"],
+            "(" + str(round(event["weighting"] * 100, 2)) + "% =>",
+            str(round(event["target"] * 100, 2)) + "%)",
         )
+        return event
+
+    def rebalance(
+        self,
+        ask_confirmation=True,
+        scheduler_stats_file=None,
+        dry_run=False,
+        backtest_cache_dir=None,
+        backtest_cache_format="json",
+    ):
+        try:
+            plan = self.plan()
+        except PlanningError as exc:
+            print(exc)
+            return False
+        if backtest_cache_dir:
+            save_crypto_listing(
+                self.get_crypto_listing(), backtest_cache_dir, backtest_cache_format
+            )
+        platform_balances = plan["platform_balances"]
+        capital = plan["capital"]
+        btc_price = self.get_crypto_price("BTC", currency="USD")
+        print("########## Balances ##########")
+        for warning in plan["warnings"]:
+            print(warning)
+        for platform, balance in platform_balances.items():
+            print(platform.capitalize(), balance, "BTC", balance * btc_price, "USD")
+            untradable_balance = plan["untradable_balances"][platform]
+            if untradable_balance:
+                print(
+                    platform.capitalize(),
+                    "not rebalanced",
+                    untradable_balance,
+                    "BTC",
+                    untradable_balance * btc_price,
+                    "USD",
+                )
+        print("Cold", plan["cold_capital"], "BTC", plan["cold_capital"] * btc_price, "USD")
         print()
-        print(
-            "Total capital",
-            capital,
-            "BTC",
-            capital * self.get_crypto_price("BTC", currency="USD"),
-            "USD",
-        )
+        print("Total capital", capital, "BTC", capital * btc_price, "USD")
         print()
         print("########## Ideal portfolio ##########")
-        ideal_portfolio = self.get_ideal_portfolio(capital)
+        ideal_portfolio = plan["ideal_portfolio"]
         for crypto in sorted(
             ideal_portfolio, key=lambda crypto: ideal_portfolio[crypto]["weighting"], reverse=True
         ):
@@ -555,8 +463,7 @@ class PortfolioManager:
             str(round(percent_change_90d, 2)) + "% 90d",
             "]",
         )
-        coinmarketcap = CoinMarketCapAPI(self.coinmarketcap_api_key, sandbox=False)
-        bitcoin_data = coinmarketcap.cryptocurrency_listings_latest(start=1, limit=1).data[0]
+        bitcoin_data = self.get_crypto_listing()[0]
         print(
             "Bitcoin change:",
             "[",
@@ -568,40 +475,27 @@ class PortfolioManager:
             "]",
         )
 
-        transfers_required = False
-        for crypto, cold_balance in self.cold_wallet.items():
-            if crypto not in ideal_portfolio and cold_balance:
-                if not transfers_required:
-                    print()
-                print("Remove", crypto, "from cold wallet")
-                transfers_required = True
-        if transfers_required:
-            exit(-1)
-        online_ideal_portfolio = self.get_portfolio_excluding_cold_wallet(ideal_portfolio)
-        ideal_portfolio_per_platform = self.get_ideal_portfolio_per_platform(
-            online_ideal_portfolio, platform_balances
-        )
-        transfers_required = False
-        for platform, portfolio in ideal_portfolio_per_platform.items():
-            for crypto in portfolio:
-                if portfolio[crypto]["quantity"] < 0:
-                    if not transfers_required:
-                        print()
+        if plan["transfers"]:
+            print()
+            for transfer in plan["transfers"]:
+                if transfer["destination"] is None:
+                    print("Remove", transfer["crypto"], "from cold wallet")
+                else:
                     print(
                         "Transfer",
-                        abs(portfolio[crypto]["quantity"]),
-                        crypto,
-                        "from cold wallet to",
-                        platform,
+                        transfer["quantity"],
+                        transfer["crypto"],
+                        "from",
+                        transfer["source"] or "another platform or cold wallet",
+                        "to",
+                        transfer["destination"],
                     )
-                    transfers_required = True
-        if transfers_required:
-            exit(-1)
-        deltas = {}
+            return False
+        ideal_portfolio_per_platform = plan["portfolios"]
+        deltas = plan["deltas"]
         for platform, portfolio in ideal_portfolio_per_platform.items():
             print()
             print("##########", platform.capitalize(), "##########")
-            new_balances = {}
             for crypto in sorted(
                 portfolio, key=lambda crypto: portfolio[crypto]["weighting"], reverse=True
             ):
@@ -610,9 +504,7 @@ class PortfolioManager:
                     str(round(ideal_portfolio[crypto]["weighting"] * 100, 2)) + "%",
                     portfolio[crypto]["quantity"],
                 )
-                new_balances[crypto] = portfolio[crypto]["quantity"]
             print()
-            deltas[platform] = self.get_delta(platform, new_balances)
             print("Added:", ", ".join(deltas[platform]["added"]))
             print("Removed:", ", ".join(deltas[platform]["removed"]))
             print("Ignored:", ", ".join(deltas[platform]["ignored"]))
@@ -625,7 +517,9 @@ class PortfolioManager:
         print()
         self.download_to_cold_wallet(ideal_portfolio)
         print()
-        if not ask_confirmation or click.confirm(
+        if dry_run:
+            print("Dry run, no order placed")
+        elif not ask_confirmation or click.confirm(
             "Do you want to perform the rebalancing now?", default=False
         ):
             print()
@@ -634,15 +528,49 @@ class PortfolioManager:
                 print()
                 print("Apply delta on", platform.capitalize())
                 self.apply_delta(platform, deltas[platform])
+        if scheduler_stats_file:
+            self.scheduler.export_wait_times(scheduler_stats_file)
+        return True
 
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: cryptolio settings.cfg")
-        exit(-1)
+def get_book_price(book, side, amount):
+    # Price of the last level needed to fill the amount, None when the book is not deep enough
+    filled = 0
+    for price, quantity in book["asks"] if side == "buy" else book["bids"]:
+        filled += quantity
+        if filled >= amount:
+            return price
+    return None
+
+
+def get_crypto_listing(coinmarketcap_api_key):
+    coinmarketcap = CoinMarketCapAPI(coinmarketcap_api_key, sandbox=False)
+    return coinmarketcap.cryptocurrency_listings_latest(limit=1000).data
+
+
+def save_crypto_listing(crypto_listing, cache_dir, cache_format="json"):
+    # The historical snapshots used by the backtests are taken every sunday
+    today = datetime.datetime.utcnow()
+    if today.weekday() != 6:
+        return False
+    date = datetime.datetime(today.year, today.month, today.day)
+    crypto_list = [normalize_crypto(crypto) for crypto in crypto_listing]
+    cache = SnapshotCache(cache_dir, cache_format)
+    try:
+        # Checked under the writer lock, another account may save the same sunday
+        if not cache.put(date, [crypto for crypto in crypto_list if crypto], overwrite=False):
+            return False
+    finally:
+        cache.close()
+    print("Listing saved into the backtest cache for", date.date())
+    return True
 
+
+def read_settings(settings_file):
     config = configparser.ConfigParser()
-    config.read(sys.argv[1])
+    if not config.read(settings_file):
+        print("Unable to read", settings_file)
+        exit(-1)
     coinmarketcap_api_key = config["DEFAULT"]["coinmarketcap_api_key"]
     manual_weightings = {}
     for crypto, weighting in config.items("MANUAL_WEIGHTINGS"):
@@ -707,17 +635,217 @@ def main():
     if trading_slippage < 0 or trading_slippage > 1:
         print("Trading slippage must be between 0 and 1")
         exit(-1)
-    portfolio = PortfolioManager(
-        coinmarketcap_api_key,
-        api_keys,
-        manual_weightings,
-        cold_wallet,
-        cold_wallet_ratio,
-        capping_level,
-        number_of_cryptos,
-        trading_slippage,
-    )
-    portfolio.rebalance(ask_confirmation)
+    order_netting = config["DEFAULT"].get("order_netting", "false")
+    if order_netting.lower() not in ["true", "false"]:
+        print("Order netting must be true or false")
+        exit(-1)
+    order_netting = order_netting.lower() == "true"
+    rate_limits = {}
+    if config.has_section("RATE_LIMITS"):
+        for key, rate in config.items("RATE_LIMITS"):
+            if key not in [option for option, _ in config.items("DEFAULT")]:
+                rate = float(rate.split("#")[0].strip())
+                if rate <= 0:
+                    print("Rate limits must be positive numbers of requests per second")
+                    exit(-1)
+                rate_limits[key] = rate
+    scheduler_stats_file = config["DEFAULT"].get("scheduler_stats_file", "").strip()
+    drift_band = float(config["DEFAULT"].get("drift_band", "0.2"))
+    if drift_band <= 0:
+        print("Drift band must be a positive number")
+        exit(-1)
+    monitor_interval = float(config["DEFAULT"].get("monitor_interval", "60"))
+    order_book_pricing = config["DEFAULT"].get("order_book_pricing", "true")
+    if order_book_pricing.lower() not in ["true", "false"]:
+        print("Order book pricing must be true or false")
+        exit(-1)
+    order_book_pricing = order_book_pricing.lower() == "true"
+    token_registry_file = config["DEFAULT"].get("token_registry_file", "").strip() or None
+    token_registry_max_age = float(config["DEFAULT"].get("token_registry_max_age", "7"))
+    if token_registry_max_age < 0:
+        print("Token registry max age must be a positive number")
+        exit(-1)
+    order_book_depth = int(config["DEFAULT"].get("order_book_depth", "20"))
+    order_book_max_age = float(config["DEFAULT"].get("order_book_max_age", "10"))
+    if order_book_depth < 1 or order_book_max_age < 0:
+        print("Order book depth and max age must be positive numbers")
+        exit(-1)
+    ledger_dir = config["DEFAULT"].get("ledger_dir", "").strip() or None
+    backtest_cache_dir = config["DEFAULT"].get("backtest_cache_dir", "").strip() or None
+    backtest_cache_format = config.get("BACKTEST", "cache_format", fallback="json").strip().lower()
+    if backtest_cache_format not in CACHE_FORMATS:
+        print("Cache format must be one of", ", ".join(CACHE_FORMATS))
+        exit(-1)
+    return {
+        "portfolio": {
+            "coinmarketcap_api_key": coinmarketcap_api_key,
+            "api_keys": api_keys,
+            "manual_weightings": manual_weightings,
+            "cold_wallet": cold_wallet,
+            "cold_wallet_ratio": cold_wallet_ratio,
+            "capping_level": capping_level,
+            "number_of_cryptos": number_of_cryptos,
+            "trading_slippage": trading_slippage,
+            "order_netting": order_netting,
+            "rate_limits": rate_limits,
+            "ledger_dir": ledger_dir,
+            "order_book_pricing": order_book_pricing,
+            "order_book_depth": order_book_depth,
+            "order_book_max_age": order_book_max_age,
+            "token_registry_file": token_registry_file,
+            "token_registry_max_age": token_registry_max_age,
+        },
+        "rebalance": {
+            "ask_confirmation": ask_confirmation,
+            "scheduler_stats_file": scheduler_stats_file,
+            "backtest_cache_dir": backtest_cache_dir,
+            "backtest_cache_format": backtest_cache_format,
+        },
+        "monitor": {"drift_band": drift_band, "monitor_interval": monitor_interval},
+    }
+
+
+def get_shared_rate_limits(settings_list):
+    rate_limits = {}
+    for settings in settings_list:
+        for key, rate in settings["portfolio"]["rate_limits"].items():
+            if rate_limits.setdefault(key, rate) != rate:
+                print("Conflicting", key, "rate limits among the settings files")
+                exit(-1)
+    return rate_limits
+
+
+def get_account_rate_limits(settings_list, rate_limits):
+    # The accounts run in parallel from the same IP, each one gets a share of the platform budget
+    accounts = {}
+    for settings in settings_list:
+        for platform in settings["portfolio"]["api_keys"]:
+            accounts[platform] = accounts.get(platform, 0) + 1
+    account_rate_limits = {}
+    for platform, count in accounts.items():
+        rate = rate_limits.get(platform, 1000 / getattr(ccxt, platform)().rateLimit)
+        account_rate_limits[platform] = rate / count
+        for key, rate in rate_limits.items():
+            if key.startswith(platform + "."):
+                account_rate_limits[key] = rate / count
+    return account_rate_limits
+
+
+def fetch_shared_data(settings_list, rate_limits):
+    # Public data is the same for every account, fetch it only once
+    scheduler = RequestScheduler(rate_limits)
+    platforms = []
+    for settings in settings_list:
+        for platform in settings["portfolio"]["api_keys"]:
+            if platform not in platforms:
+                platforms.append(platform)
+                scheduler.register(platform, getattr(ccxt, platform)())
+    with ThreadPoolExecutor() as executor:
+        crypto_listing = executor.submit(
+            get_crypto_listing, settings_list[0]["portfolio"]["coinmarketcap_api_key"]
+        )
+        tickers = dict(
+            (platform, executor.submit(scheduler.call, platform, "fetch_tickers"))
+            for platform in platforms
+        )
+        markets = dict(
+            (platform, executor.submit(scheduler.call, platform, "load_markets"))
+            for platform in platforms
+        )
+    return {
+        "crypto_listing": crypto_listing.result(),
+        "tickers": dict((platform, future.result()) for platform, future in tickers.items()),
+        "markets": dict((platform, future.result()) for platform, future in markets.items()),
+    }
+
+
+def get_report_file(settings_file):
+    return os.path.splitext(settings_file)[0] + ".log"
+
+
+def rebalance_account(settings_file, settings, shared_data):
+    report_file = get_report_file(settings_file)
+    with open(report_file, "w") as report, contextlib.redirect_stdout(report):
+        try:
+            portfolio = PortfolioManager(**settings["portfolio"], **shared_data)
+            # Nobody can answer a confirmation in batch mode: only plan these accounts
+            if not portfolio.rebalance(
+                ask_confirmation=False,
+                scheduler_stats_file=settings["rebalance"]["scheduler_stats_file"],
+                dry_run=settings["rebalance"]["ask_confirmation"],
+            ):
+                return report_file, "FAILED"
+        except SystemExit:
+            return report_file, "FAILED"
+        except Exception as exc:
+            print("FAILED:", str(exc))
+            return report_file, "FAILED"
+    if settings["rebalance"]["ask_confirmation"]:
+        return report_file, "PLANNED"
+    return report_file, "DONE"
+
+
+def rebalance_accounts(settings_files):
+    settings_list = [read_settings(settings_file) for settings_file in settings_files]
+    rate_limits = get_shared_rate_limits(settings_list)
+    print("Fetching shared market data...")
+    shared_data = fetch_shared_data(settings_list, rate_limits)
+    account_rate_limits = get_account_rate_limits(settings_list, rate_limits)
+    for settings in settings_list:
+        settings["portfolio"]["rate_limits"] = account_rate_limits
+    # The listing is shared, it is saved once instead of by every account
+    if settings_list[0]["rebalance"]["backtest_cache_dir"]:
+        save_crypto_listing(
+            shared_data["crypto_listing"],
+            settings_list[0]["rebalance"]["backtest_cache_dir"],
+            settings_list[0]["rebalance"]["backtest_cache_format"],
+        )
+    with ProcessPoolExecutor() as executor:
+        futures = [
+            executor.submit(rebalance_account, settings_file, settings, shared_data)
+            for settings_file, settings in zip(settings_files, settings_list)
+        ]
+        for settings_file, future in zip(settings_files, futures):
+            report_file, status = future.result()
+            print(settings_file, status, "(report written to " + report_file + ")")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: cryptolio-rebalancing settings.cfg [settings.cfg...]")
+        exit(-1)
+    if len(sys.argv) > 2:
+        rebalance_accounts(sys.argv[1:])
+        return
+    settings = read_settings(sys.argv[1])
+    portfolio = PortfolioManager(**settings["portfolio"])
+    if not portfolio.rebalance(**settings["rebalance"]):
+        exit(-1)
+
+
+def monitor():
+    if len(sys.argv) != 2:
+        print("Usage: cryptolio-monitor settings.cfg")
+        exit(-1)
+    settings = read_settings(sys.argv[1])
+    monitor_interval = settings["monitor"]["monitor_interval"]
+    after_rebalance = False
+    while True:
+        portfolio = PortfolioManager(**settings["portfolio"])
+        event = portfolio.watch(**settings["monitor"], after_rebalance=after_rebalance)
+        print()
+        if not event:
+            # The planning failed, try again later with fresh balances and listing
+            time.sleep(monitor_interval)
+            continue
+        # Balances and listing may have changed while watching
+        portfolio = PortfolioManager(**settings["portfolio"])
+        if not portfolio.rebalance(**settings["rebalance"]):
+            print("Rebalancing not possible, monitoring goes on")
+        after_rebalance = True
+        print()
+        # Leave time to the orders and the prices before watching the drift again
+        time.sleep(monitor_interval)
 
 
 if __name__ == "__main__":
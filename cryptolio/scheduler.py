@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+
+import ccxt
+
+PRIORITY_ORDER = 0
+PRIORITY_FETCH = 1
+PRIORITY_POLL = 2
+
+ENDPOINT_PRIORITIES = {
+    "create_limit_buy_order": PRIORITY_ORDER,
+    "create_limit_sell_order": PRIORITY_ORDER,
+    "create_order": PRIORITY_ORDER,
+    "cancel_order": PRIORITY_ORDER,
+    "fetch_order": PRIORITY_POLL,
+    "fetch_open_orders": PRIORITY_POLL,
+}
+
+# Placing an order is not idempotent: only retry when the exchange explicitly refused the request
+NON_IDEMPOTENT_ENDPOINTS = ["create_limit_buy_order", "create_limit_sell_order", "create_order"]
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def get_delay(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def empty(self, now):
+        self.refill(now)
+        self.tokens = min(self.tokens, 0)
+
+
+class RequestScheduler:
+    def __init__(self, rate_limits={}, max_retries=5, backoff=1, max_backoff=60):
+        self.rate_limits = rate_limits
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.exchanges = {}
+        self.queues = {}
+        self.buckets = {}
+        self.paused_until = {}
+        self.wait_times = {}
+
+    def register(self, platform, exchange):
+        # ccxt throttling is replaced by the scheduler buckets, shared by all the callers
+        rate = self.rate_limits.get(platform, 1000 / exchange.rateLimit)
+        exchange.enableRateLimit = False
+        self.exchanges[platform] = exchange
+        self.queues[platform] = []
+        self.buckets[platform] = TokenBucket(rate)
+        self.paused_until[platform] = 0
+        return exchange
+
+    def get_bucket(self, platform, endpoint):
+        # Called under the condition lock, a single bucket is ever created for an endpoint
+        key = platform + "." + endpoint
+        if key not in self.buckets:
+            if key not in self.rate_limits:
+                return None
+            self.buckets[key] = TokenBucket(self.rate_limits[key])
+        return self.buckets[key]
+
+    def acquire(self, platform, endpoint, priority):
+        enqueued = time.monotonic()
+        ticket = (priority, next(self.counter))
+        with self.condition:
+            buckets = [self.buckets[platform]]
+            endpoint_bucket = self.get_bucket(platform, endpoint)
+            if endpoint_bucket:
+                buckets.append(endpoint_bucket)
+            queue = self.queues[platform]
+            heapq.heappush(queue, ticket)
+            while True:
+                if queue[0] == ticket:
+                    now = time.monotonic()
+                    delay = max(
+                        [self.paused_until[platform] - now]
+                        + [bucket.get_delay(now) for bucket in buckets]
+                    )
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                else:
+                    self.condition.wait()
+            for bucket in buckets:
+                bucket.consume()
+            heapq.heappop(queue)
+            self.record_wait_time(platform, endpoint, time.monotonic() - enqueued)
+            self.condition.notify_all()
+
+    def pause(self, platform, delay):
+        with self.condition:
+            now = time.monotonic()
+            self.paused_until[platform] = max(self.paused_until[platform], now + delay)
+            self.buckets[platform].empty(now)
+            self.condition.notify_all()
+
+    def call(self, platform, endpoint, *args, priority=None, **kwargs):
+        if priority is None:
+            priority = ENDPOINT_PRIORITIES.get(endpoint, PRIORITY_FETCH)
+        if endpoint in NON_IDEMPOTENT_ENDPOINTS:
+            retried_exceptions = ccxt.DDoSProtection
+        else:
+            retried_exceptions = ccxt.NetworkError
+        function = getattr(self.exchanges[platform], endpoint)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(platform, endpoint, priority)
+            try:
+                return function(*args, **kwargs)
+            except retried_exceptions:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(self.backoff * 2**attempt, self.max_backoff)
+                self.pause(platform, delay * random.uniform(0.5, 1))
+
+    def record_wait_time(self, platform, endpoint, wait_time):
+        key = (platform, endpoint)
+        if key not in self.wait_times:
+            self.wait_times[key] = {"count": 0, "total": 0, "max": 0}
+        stats = self.wait_times[key]
+        stats["count"] += 1
+        stats["total"] += wait_time
+        stats["max"] = max(stats["max"], wait_time)
+
+    def get_wait_times(self):
+        with self.condition:
+            return dict(
+                (
+                    platform + "." + endpoint,
+                    {
+                        "count": stats["count"],
+                        "mean": stats["total"] / stats["count"],
+                        "max": stats["max"],
+                        "total": stats["total"],
+                    },
+                )
+                for (platform, endpoint), stats in sorted(self.wait_times.items())
+            )
+
+    def export_wait_times(self, path):
+        with open(path, "w") as stats_file:
+            json.dump(self.get_wait_times(), stats_file, indent=2)
@@ -0,0 +1,51 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+QUANTILES = [0.05, 0.5, 0.95]
+
+
+def get_returns(results):
+    balances = np.array([balance for _, balance in results], dtype=float)
+    return balances[1:] / balances[:-1]
+
+
+def simulate_paths(returns, paths, block_size, capital, seed):
+    # Moving block bootstrap: paths are built from random blocks of consecutive weekly returns
+    random = np.random.default_rng(seed)
+    horizon = len(returns)
+    blocks = -(-horizon // block_size)
+    starts = random.integers(0, horizon - block_size + 1, size=(paths, blocks))
+    indexes = (starts[:, :, np.newaxis] + np.arange(block_size)).reshape(paths, -1)[:, :horizon]
+    balances = capital * np.cumprod(returns[indexes], axis=1)
+    peaks = np.maximum(np.maximum.accumulate(balances, axis=1), capital)
+    drawdowns = (1 - balances / peaks).max(axis=1)
+    return balances[:, -1], drawdowns
+
+
+def simulate(results, paths=1000, block_size=4, chunk_size=10000, workers=1, seed=None):
+    returns = get_returns(results)
+    if not len(returns) or not paths:
+        return None
+    block_size = max(min(block_size, len(returns)), 1)
+    # Chunks bound the memory used by the paths, each one gets an independent random stream
+    chunks = [min(chunk_size, paths - start) for start in range(0, paths, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    arguments = [
+        [returns] * len(chunks),
+        chunks,
+        [block_size] * len(chunks),
+        [results[0][1]] * len(chunks),
+        seeds,
+    ]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            simulations = list(executor.map(simulate_paths, *arguments))
+    else:
+        simulations = list(map(simulate_paths, *arguments))
+    final_capital = np.concatenate([simulation[0] for simulation in simulations])
+    drawdowns = np.concatenate([simulation[1] for simulation in simulations])
+    return {
+        "final_capital": np.quantile(final_capital, QUANTILES),
+        "max_drawdown": np.quantile(drawdowns, QUANTILES),
+    }
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+import contextlib
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+import ccxt
+
+from cryptolio.planning import PlanningError
+from cryptolio.rebalancing import PortfolioManager
+
+
+class SimulatedExchange:
+    # In-process ccxt-like exchange: only the methods used by the rebalancing are implemented
+    precisionMode = ccxt.DECIMAL_PLACES
+    has = {"fetchOrderBooks": True}
+
+    def __init__(
+        self,
+        balances,
+        prices,
+        markets=None,
+        latency=0,
+        latency_jitter=0,
+        rate_limit=0,
+        reject_rate=0,
+        fill_rate=0.5,
+        spread=0.002,
+        depth=10,
+        level_cost=0.05,
+        fees=0.001,
+        seed=None,
+    ):
+        self.balances = dict(
+            (crypto, {"free": float(quantity), "used": 0.0})
+            for crypto, quantity in balances.items()
+        )
+        self.prices = dict(prices)
+        self.markets = markets or dict(
+            (
+                symbol,
+                {
+                    "symbol": symbol,
+                    "base": symbol.split("/")[0],
+                    "quote": symbol.split("/")[1],
+                    "limits": {"amount": {"min": 0.01, "max": None}, "cost": {"min": 0.0001}},
+                    "precision": {"amount": 2, "price": 8},
+                },
+            )
+            for symbol in prices
+        )
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit = rate_limit
+        # Milliseconds between two requests, used by the scheduler throttling
+        self.rateLimit = 1000 / rate_limit if rate_limit else 1
+        self.enableRateLimit = False
+        self.reject_rate = reject_rate
+        self.fill_rate = fill_rate
+        self.spread = spread
+        self.depth = depth
+        self.level_cost = level_cost
+        self.fees = fees
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = deque()
+        self.ids = itertools.count(1)
+        self.orders = {}
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "rejected": 0,
+            "orders": 0,
+            "partial_fills": 0,
+            "filled": 0,
+        }
+
+    def request(self):
+        delay = self.latency + self.random.uniform(0, self.latency_jitter)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            now = time.monotonic()
+            self.stats["requests"] += 1
+            if self.rate_limit:
+                while self.requests and now - self.requests[0] > 1:
+                    self.requests.popleft()
+                if len(self.requests) >= self.rate_limit:
+                    self.stats["throttled"] += 1
+                    raise ccxt.DDoSProtection("Simulated rate limit exceeded")
+                self.requests.append(now)
+
+    def get_balance(self, crypto):
+        return self.balances.setdefault(crypto, {"free": 0.0, "used": 0.0})
+
+    def get_order_book(self, symbol, limit=None):
+        last = self.prices[symbol]
+        levels = range(min(limit or self.depth, self.depth))
+        step = self.spread / 2
+        asks = [last * (1 + step * (level + 1)) for level in levels]
+        bids = [last * (1 - step * (level + 1)) for level in levels]
+        return {
+            "symbol": symbol,
+            "asks": [[price, self.level_cost / price] for price in asks],
+            "bids": [[price, self.level_cost / price] for price in bids],
+            "timestamp": int(time.time() * 1000),
+            "nonce": None,
+        }
+
+    def fill(self, order, amount, price):
+        base, quote = order["symbol"].split("/")
+        if order["side"] == "buy":
+            self.get_balance(quote)["used"] -= amount * order["price"]
+            self.get_balance(quote)["free"] += amount * (order["price"] - price)
+            self.get_balance(base)["free"] += amount * (1 - self.fees)
+        else:
+            self.get_balance(base)["used"] -= amount
+            self.get_balance(quote)["free"] += amount * price * (1 - self.fees)
+        order["cost"] += amount * price
+        order["filled"] += amount
+        order["remaining"] = order["amount"] - order["filled"]
+        order["average"] = order["cost"] / order["filled"]
+        self.prices[order["symbol"]] = price
+        if order["remaining"] <= order["amount"] * 1e-9:
+            order["remaining"] = 0
+            order["status"] = "closed"
+            self.stats["filled"] += 1
+        else:
+            self.stats["partial_fills"] += 1
+
+    def match(self, order):
+        # Walk the book up to the limit price, the remaining part rests in the book
+        book = self.get_order_book(order["symbol"])
+        levels = book["asks"] if order["side"] == "buy" else book["bids"]
+        for price, quantity in levels:
+            if order["remaining"] <= 0:
+                break
+            if (order["side"] == "buy" and price > order["price"]) or (
+                order["side"] == "sell" and price < order["price"]
+            ):
+                break
+            self.fill(order, min(quantity, order["remaining"]), price)
+
+    def advance(self, order):
+        # Resting orders get a part of the remaining amount filled at each poll
+        if order["status"] != "open" or self.random.random() > self.fill_rate:
+            return
+        amount = order["remaining"] * self.random.uniform(0.5, 1)
+        if amount < order["amount"] * 0.01:
+            amount = order["remaining"]
+        self.fill(order, amount, order["price"])
+
+    def fetch_balance(self, params={}):
+        self.request()
+        with self.lock:
+            balance = {"free": {}, "used": {}, "total": {}}
+            for crypto, values in self.balances.items():
+                total = values["free"] + values["used"]
+                balance[crypto] = {"free": values["free"], "used": values["used"], "total": total}
+                balance["free"][crypto] = values["free"]
+                balance["used"][crypto] = values["used"]
+                balance["total"][crypto] = total
+            return balance
+
+    def fetch_tickers(self, symbols=None, params={}):
+        self.request()
+        with self.lock:
+            tickers = {}
+            for symbol, last in self.prices.items():
+                if symbols and symbol not in symbols:
+                    continue
+                tickers[symbol] = {
+                    "symbol": symbol,
+                    "last": last,
+                    "bid": last * (1 - self.spread / 2),
+                    "ask": last * (1 + self.spread / 2),
+                    "timestamp": int(time.time() * 1000),
+                }
+            return tickers
+
+    def load_markets(self, reload=False, params={}):
+        self.request()
+        return self.markets
+
+    def fetch_order_book(self, symbol, limit=None, params={}):
+        self.request()
+        with self.lock:
+            return self.get_order_book(symbol, limit)
+
+    def fetch_order_books(self, symbols=None, limit=None, params={}):
+        self.request()
+        with self.lock:
+            return dict(
+                (symbol, self.get_order_book(symbol, limit)) for symbol in symbols or self.prices
+            )
+
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        self.request()
+        with self.lock:
+            self.stats["orders"] += 1
+            if self.random.random() < self.reject_rate:
+                self.stats["rejected"] += 1
+                raise ccxt.InvalidOrder("Simulated order reject")
+            if symbol not in self.markets:
+                raise ccxt.BadSymbol("Unknown market " + symbol)
+            limits = self.markets[symbol]["limits"]
+            if amount < (limits["amount"]["min"] or 0) or amount * price < (
+                limits["cost"]["min"] or 0
+            ):
+                self.stats["rejected"] += 1
+                raise ccxt.InvalidOrder("Order below the market limits")
+            base, quote = symbol.split("/")
+            reserved_crypto, reserved = (quote, amount * price) if side == "buy" else (base, amount)
+            balance = self.get_balance(reserved_crypto)
+            if balance["free"] < reserved:
+                self.stats["rejected"] += 1
+                raise ccxt.InsufficientFunds("Not enough " + reserved_crypto)
+            balance["free"] -= reserved
+            balance["used"] += reserved
+            order = {
+                "id": str(next(self.ids)),
+                "symbol": symbol,
+                "type": type,
+                "side": side,
+                "price": price,
+                "amount": amount,
+                "filled": 0.0,
+                "remaining": amount,
+                "cost": 0.0,
+                "average": None,
+                "status": "open",
+                "timestamp": int(time.time() * 1000),
+            }
+            self.orders[order["id"]] = order
+            self.match(order)
+            return dict(order)
+
+    def create_limit_buy_order(self, symbol, amount, price, params={}):
+        return self.create_order(symbol, "limit", "buy", amount, price, params)
+
+    def create_limit_sell_order(self, symbol, amount, price, params={}):
+        return self.create_order(symbol, "limit", "sell", amount, price, params)
+
+    def fetch_order(self, id, symbol=None, params={}):
+        self.request()
+        with self.lock:
+            if id not in self.orders:
+                raise ccxt.OrderNotFound("Unknown order " + id)
+            order = self.orders[id]
+            self.advance(order)
+            return dict(order)
+
+    def cancel_order(self, id, symbol=None, params={}):
+        self.request()
+        with self.lock:
+            order = self.orders[id]
+            if order["status"] == "open":
+                base, quote = order["symbol"].split("/")
+                if order["side"] == "buy":
+                    released_crypto, released = quote, order["remaining"] * order["price"]
+                else:
+                    released_crypto, released = base, order["remaining"]
+                self.get_balance(released_crypto)["used"] -= released
+                self.get_balance(released_crypto)["free"] += released
+                order["status"] = "canceled"
+            return dict(order)
+
+
+def get_benchmark_data(number_of_cryptos=100, number_of_platforms=2, seed=0):
+    generator = random.Random(seed)
+    cryptos = ["BTC"] + ["SIM" + str(i) for i in range(1, number_of_cryptos)]
+    crypto_listing = []
+    prices = {}
+    for rank, crypto in enumerate(cryptos):
+        usd_price = 20000.0 if crypto == "BTC" else generator.uniform(0.01, 100)
+        quote = {"price": usd_price, "market_cap": 1e11 / (rank + 1) ** 1.5}
+        for period in ["1h", "24h", "7d", "30d", "60d", "90d"]:
+            quote["percent_change_" + period] = generator.uniform(-10, 10)
+        crypto_listing.append(
+            {
+                "cmc_rank": rank + 1,
+                "name": crypto,
+                "symbol": crypto,
+                "circulating_supply": quote["market_cap"] / usd_price,
+                "quote": {"USD": quote},
+            }
+        )
+        if crypto != "BTC":
+            prices[crypto + "/BTC"] = usd_price / 20000
+    prices["BTC/USDT"] = 20000.0
+    platforms = {}
+    for index in range(number_of_platforms):
+        # Holdings far from the ideal portfolio to get a lot of orders
+        balances = {"BTC": generator.uniform(0.5, 2), "USDT": 0}
+        for crypto in generator.sample(cryptos[1:], len(cryptos) // 2):
+            balances[crypto] = generator.uniform(0.01, 0.2) / prices[crypto + "/BTC"]
+        platforms["simulated" + str(index + 1)] = (balances, dict(prices))
+    return crypto_listing, platforms
+
+
+def main():
+    if len(sys.argv) > 3:
+        print("Usage: cryptolio-simulator [number_of_cryptos] [number_of_platforms]")
+        exit(-1)
+    number_of_cryptos = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    number_of_platforms = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    crypto_listing, platforms = get_benchmark_data(number_of_cryptos, number_of_platforms)
+    exchanges = dict(
+        (
+            platform,
+            SimulatedExchange(
+                balances,
+                prices,
+                latency=0.005,
+                latency_jitter=0.01,
+                rate_limit=50,
+                reject_rate=0.01,
+                fill_rate=0.5,
+                seed=index,
+            ),
+        )
+        for index, (platform, (balances, prices)) in enumerate(platforms.items())
+    )
+    start = time.perf_counter()
+    portfolio = PortfolioManager(
+        None,
+        {},
+        number_of_cryptos=number_of_cryptos,
+        capping_level=max(0.1, 1 / number_of_cryptos),
+        crypto_listing=crypto_listing,
+        exchanges=exchanges,
+        order_poll_interval=0,
+    )
+    try:
+        plan = portfolio.plan()
+    except PlanningError as exc:
+        print(exc)
+        exit(-1)
+    if plan["transfers"]:
+        print("Transfers required, try other parameters")
+        exit(-1)
+    planned = time.perf_counter()
+    orders = sum([len(delta["orders"]) for delta in plan["deltas"].values()])
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for platform, delta in plan["deltas"].items():
+            portfolio.apply_delta(platform, delta)
+    executed = time.perf_counter()
+    print("Planning:", "%.3f" % (planned - start), "s")
+    print(
+        "Execution:",
+        orders,
+        "orders in",
+        "%.3f" % (executed - planned),
+        "s",
+        "(%.1f orders/s)" % (orders / (executed - planned) if executed > planned else 0),
+    )
+    for platform, exchange in exchanges.items():
+        print(
+            platform.capitalize() + ":",
+            ", ".join(
+                str(value) + " " + key.replace("_", " ") for key, value in exchange.stats.items()
+            ),
+        )
+    for key, stats in portfolio.scheduler.get_wait_times().items():
+        print(
+            key,
+            "waited %.3f s on average, %.3f s at most" % (stats["mean"], stats["max"]),
+            "(" + str(stats["count"]),
+            "requests)",
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import math
+
+
+class WeightingStrategy:
+    name = None
+    # Number of previous weekly snapshots needed by the strategy
+    history_weeks = 0
+
+    def get_weightings(self, portfolio, history=[]):
+        raise NotImplementedError
+
+
+class MarketcapStrategy(WeightingStrategy):
+    name = "marketcap"
+
+    def get_weightings(self, portfolio, history=[]):
+        total_market_cap = sum([values["marketcap"] for values in portfolio.values()])
+        return dict(
+            (crypto, values["marketcap"] / total_market_cap) for crypto, values in portfolio.items()
+        )
+
+
+class SqrtMarketcapStrategy(WeightingStrategy):
+    name = "sqrt_marketcap"
+
+    def get_weightings(self, portfolio, history=[]):
+        roots = dict(
+            (crypto, math.sqrt(values["marketcap"])) for crypto, values in portfolio.items()
+        )
+        total = sum(roots.values())
+        return dict((crypto, root / total) for crypto, root in roots.items())
+
+
+class EqualStrategy(WeightingStrategy):
+    name = "equal"
+
+    def get_weightings(self, portfolio, history=[]):
+        return dict((crypto, 1 / len(portfolio)) for crypto in portfolio)
+
+
+class InverseVolatilityStrategy(WeightingStrategy):
+    name = "inverse_volatility"
+    history_weeks = 12
+
+    def get_volatility(self, prices):
+        returns = [math.log(new / old) for old, new in zip(prices[:-1], prices[1:]) if old and new]
+        if len(returns) < 2:
+            return None
+        mean = sum(returns) / len(returns)
+        return math.sqrt(sum([(r - mean) ** 2 for r in returns]) / (len(returns) - 1)) or None
+
+    def get_weightings(self, portfolio, history=[]):
+        volatilities = {}
+        for crypto, values in portfolio.items():
+            prices = [prices[crypto] for prices in history if prices.get(crypto)]
+            volatilities[crypto] = self.get_volatility(prices + [values["usd_price"]])
+        known_volatilities = sorted(v for v in volatilities.values() if v)
+        if not known_volatilities:
+            return EqualStrategy().get_weightings(portfolio)
+        # Cryptos without enough history get the median volatility
+        median = known_volatilities[len(known_volatilities) // 2]
+        inverses = dict((crypto, 1 / (v or median)) for crypto, v in volatilities.items())
+        total = sum(inverses.values())
+        return dict((crypto, inverse / total) for crypto, inverse in inverses.items())
+
+
+STRATEGIES = dict(
+    (strategy.name, strategy)
+    for strategy in [
+        MarketcapStrategy,
+        SqrtMarketcapStrategy,
+        EqualStrategy,
+        InverseVolatilityStrategy,
+    ]
+)
+
+
+def get_strategy(name):
+    return STRATEGIES[name]()
+
+
+def cap_weightings(weightings, capping_level, manual_weightings={}):
+    precision_error = 0.001
+    fixed_manual_weightings = {}
+    for crypto, weighting in manual_weightings.items():
+        if weighting not in ["auto", 0]:
+            fixed_manual_weightings[crypto] = weighting
+    weightings = dict(weightings)
+    capped_cryptos = []
+    uncapped_cryptos = True
+    while uncapped_cryptos:
+        uncapped_cryptos = sorted(
+            crypto
+            for crypto, weighting in weightings.items()
+            if (
+                crypto not in fixed_manual_weightings
+                and weighting > capping_level + precision_error
+            )
+            or (
+                crypto in fixed_manual_weightings
+                and abs(weighting - fixed_manual_weightings[crypto]) > precision_error
+            )
+        )
+        for crypto in uncapped_cryptos:
+            weightings[crypto] = fixed_manual_weightings.get(crypto, capping_level)
+            capped_cryptos.append(crypto)
+        weightings_sum_not_capped = sum(
+            [weightings[crypto] for crypto in weightings if crypto not in capped_cryptos]
+        )
+        weightings_sum_capped = sum(
+            [weightings[crypto] for crypto in weightings if crypto in capped_cryptos]
+        )
+        for crypto in weightings:
+            if crypto not in capped_cryptos:
+                weightings[crypto] *= (1 - weightings_sum_capped) / weightings_sum_not_capped
+    assert abs(sum(weightings.values()) - 1) < 0.01
+    return weightings
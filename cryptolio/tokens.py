@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+
+TOKENS_URL = "https://raw.githubusercontent.com/kvhnuke/etherwallet/mercury/app/scripts/tokens/ethTokens.json"
+# Bumped when the registry file layout changes to ignore the old caches
+REGISTRY_VERSION = 1
+SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "eth_tokens.json")
+
+
+def download_symbols(url=TOKENS_URL, timeout=30):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return sorted(set(token["symbol"] for token in json.loads(response.read().decode())))
+
+
+def read_registry(registry_file):
+    try:
+        with open(registry_file) as registry:
+            data = json.load(registry)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != REGISTRY_VERSION:
+        return None
+    return data
+
+
+def write_registry(registry_file, symbols, source=TOKENS_URL):
+    # Written aside then renamed, a concurrent reader never sees a partial file
+    directory = os.path.dirname(os.path.abspath(registry_file))
+    os.makedirs(directory, exist_ok=True)
+    data = {
+        "version": REGISTRY_VERSION,
+        "updated": time.time(),
+        "source": source,
+        "symbols": symbols,
+    }
+    fd, temp_file = tempfile.mkstemp(prefix=".tokens-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as registry:
+            json.dump(data, registry)
+        os.replace(temp_file, registry_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+    return data
+
+
+class TokenRegistry:
+    # Tokens the cold wallet can hold, kept apart from the actual cold wallet balances
+    def __init__(self, cache_file=None, max_age=7, url=TOKENS_URL):
+        self.cache_file = cache_file
+        self.max_age = max_age
+        self.url = url
+        self.symbols = None
+        self.updated = None
+
+    def load(self):
+        # Fresh local cache, then download, then stale local cache, then bundled snapshot
+        if self.symbols is not None:
+            return
+        cache = read_registry(self.cache_file) if self.cache_file else None
+        if cache and time.time() - cache["updated"] < self.max_age * 86400:
+            self.set_symbols(cache)
+            return
+        try:
+            symbols = download_symbols(self.url)
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            print("Unable to download the token registry (" + str(exc) + ")")
+        else:
+            if self.cache_file:
+                self.set_symbols(write_registry(self.cache_file, symbols, self.url))
+            else:
+                self.set_symbols({"updated": time.time(), "symbols": symbols})
+            return
+        if cache:
+            print("Using the token registry cached", time.ctime(cache["updated"]))
+            self.set_symbols(cache)
+            return
+        snapshot = read_registry(SNAPSHOT_FILE)
+        if not snapshot:
+            print("Bundled token registry snapshot not found")
+            snapshot = {"updated": None, "symbols": []}
+        elif not snapshot["updated"]:
+            # The seed only lists well-known tokens, it is never trusted as a complete list
+            print(
+                "Warning, only the partial token list bundled with cryptolio is available,",
+                "the cold wallet transfers of the other tokens are not advised",
+            )
+        else:
+            print("Using the bundled token registry snapshot of", time.ctime(snapshot["updated"]))
+        self.set_symbols(snapshot)
+
+    def set_symbols(self, registry):
+        self.symbols = frozenset(registry["symbols"])
+        self.updated = registry["updated"]
+
+    def supports(self, symbol):
+        self.load()
+        return symbol in self.symbols
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: cryptolio-tokens registry_file")
+        exit(-1)
+    try:
+        symbols = download_symbols()
+    except (OSError, ValueError, KeyError, TypeError) as exc:
+        print("Unable to download the token registry (" + str(exc) + ")")
+        exit(-1)
+    write_registry(sys.argv[1], symbols)
+    print(len(symbols), "tokens written to", sys.argv[1])
+
+
+if __name__ == "__main__":
+    main()
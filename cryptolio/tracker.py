@@ -0,0 +1,110 @@
+import heapq
+
+
+class DriftTracker:
+    # Incremental valuation: a price update only revalues the updated crypto
+    def __init__(self, quantities, prices, targets, drift_band=0.2, on_drift=None):
+        self.quantities = dict(quantities)
+        self.targets = dict(
+            (crypto, weighting) for crypto, weighting in targets.items() if weighting
+        )
+        self.min_target = min(self.targets.values())
+        self.drift_band = drift_band
+        self.on_drift = on_drift
+        self.prices = {}
+        self.values = {}
+        self.ratios = {}
+        self.nav = 0
+        # Value to target ratios of the portfolio cryptos and values of the other ones
+        self.max_ratios = []
+        self.min_ratios = []
+        self.stray_values = []
+        self.drifting = False
+        for crypto in set(self.quantities) | set(self.targets):
+            self.set_price(crypto, prices.get(crypto, 0))
+
+    def set_price(self, crypto, price):
+        value = self.quantities.get(crypto, 0) * price
+        self.nav += value - self.values.get(crypto, 0)
+        self.values[crypto] = value
+        self.prices[crypto] = price
+        if crypto in self.targets:
+            ratio = value / self.targets[crypto]
+            self.ratios[crypto] = ratio
+            heapq.heappush(self.max_ratios, (-ratio, crypto))
+            heapq.heappush(self.min_ratios, (ratio, crypto))
+        elif value:
+            heapq.heappush(self.stray_values, (-value, crypto))
+        # Stale entries are dropped lazily, rebuild the heaps before they grow too much
+        if len(self.max_ratios) > 4 * len(self.targets) + 16:
+            self.max_ratios = [(-ratio, crypto) for crypto, ratio in self.ratios.items()]
+            self.min_ratios = [(ratio, crypto) for crypto, ratio in self.ratios.items()]
+            heapq.heapify(self.max_ratios)
+            heapq.heapify(self.min_ratios)
+        if len(self.stray_values) > 4 * (len(self.values) - len(self.targets)) + 16:
+            self.stray_values = [
+                (-value, crypto)
+                for crypto, value in self.values.items()
+                if crypto not in self.targets and value
+            ]
+            heapq.heapify(self.stray_values)
+
+    def get_top(self, heap, values, sign):
+        while heap and sign * heap[0][0] != values.get(heap[0][1]):
+            heapq.heappop(heap)
+        if not heap:
+            return None, 0
+        return heap[0][1], sign * heap[0][0]
+
+    def get_weighting(self, crypto):
+        if not self.nav:
+            return 0
+        return self.values.get(crypto, 0) / self.nav
+
+    def get_drift(self, crypto):
+        # Relative to the target, cryptos out of the portfolio are compared to the smallest target
+        if crypto in self.targets:
+            return self.get_weighting(crypto) / self.targets[crypto] - 1
+        return self.get_weighting(crypto) / self.min_target
+
+    def get_max_drift(self):
+        if not self.nav:
+            return None, 0
+        candidates = []
+        crypto, ratio = self.get_top(self.max_ratios, self.ratios, -1)
+        candidates.append((crypto, ratio / self.nav - 1))
+        crypto, ratio = self.get_top(self.min_ratios, self.ratios, 1)
+        candidates.append((crypto, ratio / self.nav - 1))
+        crypto, value = self.get_top(self.stray_values, self.values, -1)
+        if crypto:
+            candidates.append((crypto, value / self.nav / self.min_target))
+        return max(candidates, key=lambda candidate: abs(candidate[1]))
+
+    def check(self):
+        crypto, drift = self.get_max_drift()
+        if abs(drift) <= self.drift_band:
+            self.drifting = False
+            return None
+        if self.drifting:
+            return None
+        # Only notify when entering the drift state
+        self.drifting = True
+        event = {
+            "crypto": crypto,
+            "drift": drift,
+            "weighting": self.get_weighting(crypto),
+            "target": self.targets.get(crypto, 0),
+            "nav": self.nav,
+        }
+        if self.on_drift:
+            self.on_drift(event)
+        return event
+
+    def update_price(self, crypto, price):
+        self.set_price(crypto, price)
+        return self.check()
+
+    def update_quantity(self, crypto, quantity, price=None):
+        self.quantities[crypto] = quantity
+        self.set_price(crypto, self.prices.get(crypto, 0) if price is None else price)
+        return self.check()
@@ -3,6 +3,7 @@ from distutils.core import setup
 setup(
     name='cryptolio',
     packages=['cryptolio'],
+    package_data={'cryptolio': ['data/*.json']},
     version='0.0.1',
     description='Cryptocurrency portfolio rebalancing',
     author='François Rossigneux',
@@ -19,17 +20,24 @@ setup(
         'Topic :: Office/Business :: Financial :: Investment',
     ],
     install_requires=[
+        'aiohttp',
         'click',
         'python-coinmarketcap',
         'ccxt',
         'lxml',
         'matplotlib',
+        'numpy',
         'semidbm',
     ],
     entry_points={
         'console_scripts': [
             'cryptolio-rebalancing = cryptolio.rebalancing:main',
-            'cryptolio-backtest = cryptolio.backtest:main'
+            'cryptolio-monitor = cryptolio.rebalancing:monitor',
+            'cryptolio-backtest = cryptolio.backtest:main',
+            'cryptolio-cache = cryptolio.cache:main',
+            'cryptolio-simulator = cryptolio.simulator:main',
+            'cryptolio-ledger = cryptolio.ledger:main',
+            'cryptolio-tokens = cryptolio.tokens:main',
         ]
     },
     long_description="""\
@@ -0,0 +1,144 @@
+import multiprocessing
+import os
+
+from cryptolio.cache import SnapshotCache, WeightsMemo
+
+PROCESSES = 4
+KEYS = 50
+CRYPTO_LIST = [
+    {"name": "Bitcoin", "symbol": "BTC", "marketcap": 250e9, "usd_price": 15000.0},
+    {"name": "Ethereum", "symbol": "ETH", "marketcap": 100e9, "usd_price": 1000.5},
+]
+
+
+def fill_memo(memo_dir, worker, errors):
+    memo = WeightsMemo(memo_dir)
+    try:
+        for i in range(KEYS):
+            key = str(worker) + "|" + str(i)
+            targets = {"BTC": {"weighting": worker + i / KEYS, "padding": "x" * (i * 37 % 500)}}
+            memo.put(key, targets)
+            if memo.get(key) != targets:
+                errors.put(key)
+            # Keys of the other processes are either missing or complete
+            other = str((worker + 1) % PROCESSES) + "|" + str(i)
+            value = memo.get(other)
+            if (
+                value is not None
+                and value["BTC"]["weighting"] != (worker + 1) % PROCESSES + i / KEYS
+            ):
+                errors.put(other)
+    finally:
+        memo.close()
+
+
+def test_weights_memo_shared_by_processes(tmp_path):
+    memo_dir = str(tmp_path / "memo")
+    errors = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=fill_memo, args=(memo_dir, worker, errors))
+        for worker in range(PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    assert errors.empty()
+    memo = WeightsMemo(memo_dir)
+    for worker in range(PROCESSES):
+        for i in range(KEYS):
+            assert memo.get(str(worker) + "|" + str(i))["BTC"]["weighting"] == worker + i / KEYS
+    memo.close()
+
+
+def test_weights_memo_unreadable_record_is_a_miss(tmp_path):
+    memo_dir = str(tmp_path / "memo")
+    memo = WeightsMemo(memo_dir)
+    memo.put("key", {"BTC": {"weighting": 1}})
+    memo.close()
+    with open(memo_dir + "/data", "r+b") as data_file:
+        data = data_file.read()
+        data_file.seek(data.index(b"weighting"))
+        data_file.write(b"WEIGHTING")
+    memo = WeightsMemo(memo_dir)
+    assert memo.get("key") is None
+    memo.close()
+
+
+def test_write_after_interrupted_append(tmp_path):
+    memo_dir = str(tmp_path / "memo")
+    memo = WeightsMemo(memo_dir)
+    memo.put("kept", {"BTC": {"weighting": 1}})
+    memo.put("partial", {"ETH": {"weighting": 2}})
+    # A writer crashing in the middle of its append
+    size = os.path.getsize(memo_dir + "/data")
+    os.truncate(memo_dir + "/data", size - 5)
+    memo.put("next", {"LTC": {"weighting": 3}})
+    memo.close()
+    memo = WeightsMemo(memo_dir)
+    assert memo.get("kept") == {"BTC": {"weighting": 1}}
+    assert memo.get("partial") is None
+    assert memo.get("next") == {"LTC": {"weighting": 3}}
+    memo.compact()
+    assert memo.get("next") == {"LTC": {"weighting": 3}}
+    memo.close()
+
+
+def test_reader_reopens_after_interrupted_append(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = SnapshotCache(cache_dir, "packed")
+    cache.put("2018-01-07", CRYPTO_LIST)
+    reader = SnapshotCache(cache_dir)
+    cache.put("2018-01-14", CRYPTO_LIST)
+    os.truncate(cache_dir + "/data", os.path.getsize(cache_dir + "/data") - 20)
+    assert reader.keys() == ["2018-01-07"]
+    assert reader.get("2018-01-07") == CRYPTO_LIST
+    reader.put("2018-01-14", CRYPTO_LIST)
+    assert cache.get("2018-01-14") == CRYPTO_LIST
+    cache.close()
+    reader.close()
+
+
+def get_snapshot(index):
+    return [dict(crypto, marketcap=crypto["marketcap"] + index) for crypto in CRYPTO_LIST]
+
+
+def write_snapshots(cache_dir):
+    cache = SnapshotCache(cache_dir, "packed")
+    for i in range(KEYS):
+        cache.put("snapshot" + str(i).zfill(3), get_snapshot(i))
+        if i == KEYS // 2:
+            cache.compact()
+    cache.close()
+
+
+def read_snapshots(cache_dir, errors):
+    cache = SnapshotCache(cache_dir)
+    try:
+        while True:
+            keys = cache.keys()
+            for key in keys:
+                if cache.get(key) != get_snapshot(int(key[len("snapshot") :])):
+                    errors.put(key)
+            if len(keys) == KEYS:
+                break
+    except Exception as exc:
+        errors.put(repr(exc))
+    finally:
+        cache.close()
+
+
+def test_snapshot_cache_read_while_written(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    SnapshotCache(cache_dir).close()
+    errors = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=write_snapshots, args=(cache_dir,))] + [
+        multiprocessing.Process(target=read_snapshots, args=(cache_dir, errors)) for _ in range(2)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    assert errors.empty()
@@ -0,0 +1,32 @@
+import numpy as np
+
+from cryptolio.charts import decimate
+
+
+def test_decimate_keeps_endpoints_and_bucket_extremes():
+    random = np.random.RandomState(0)
+    x = list(range(1000))
+    y = list(np.cumsum(random.normal(size=1000)))
+    decimated_x, decimated_y = decimate(x, y, 50)
+    assert len(decimated_x) <= 50
+    assert decimated_x == sorted(decimated_x)
+    assert decimated_x[0] == 0 and decimated_x[-1] == 999
+    assert decimated_y == [y[i] for i in decimated_x]
+    # (50 - 2) // 2 buckets, each one keeping its lowest and highest value
+    bounds = np.linspace(0, 1000, 25, dtype=int)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        assert start + int(np.argmin(y[start:end])) in decimated_x
+        assert start + int(np.argmax(y[start:end])) in decimated_x
+    assert min(y) in decimated_y and max(y) in decimated_y
+
+
+def test_decimate_short_or_unlimited_series_unchanged():
+    assert decimate([1, 2, 3], [3, 1, 2], 500) == ([1, 2, 3], [3, 1, 2])
+    assert decimate(range(10), range(10), 0) == (list(range(10)), list(range(10)))
+
+
+def test_decimate_small_maximum_clamped_to_4_points():
+    y = [0, 5, -3, 2, 8, 1, -1, 4]
+    x, decimated_y = decimate(list(range(8)), y, 1)
+    assert x == [0, 2, 4, 7]
+    assert decimated_y == [0, -3, 8, 4]
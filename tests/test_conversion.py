@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+from cryptolio.conversion import ConversionGraph
+
+
+def get_tickers(prices):
+    return dict((symbol, {"symbol": symbol, "last": price}) for symbol, price in prices.items())
+
+
+PRICES = {
+    "ETH/BTC": 0.05,
+    "BTC/USDT": 20000,
+    "XYZ/ETH": 0.1,
+    "ABC/USDT": 2,
+    "DIRECT/ETH": 0.2,
+    "DIRECT/BTC": 0.02,
+    "BTC/USDT:USDT": 25000,
+}
+
+
+def test_rates_through_fewest_markets():
+    graph = ConversionGraph(get_tickers(PRICES))
+    assert graph.get_rate("BTC") == 1
+    assert graph.get_rate("ETH") == pytest.approx(0.05)
+    assert graph.get_rate("USDT") == pytest.approx(1 / 20000)
+    assert graph.get_rate("XYZ") == pytest.approx(0.005)
+    assert graph.get_rate("ABC") == pytest.approx(0.0001)
+    # The direct market wins over the path through ETH, the derivative market is ignored
+    assert graph.get_rate("DIRECT") == pytest.approx(0.02)
+    assert graph.get_rate("UNKNOWN") is None
+
+
+def test_usd_rates_go_through_usdt():
+    graph = ConversionGraph(get_tickers(PRICES))
+    assert graph.get_rate("BTC", "USD") == pytest.approx(20000)
+    assert graph.get_rate("ETH", "USD") == pytest.approx(1000)
+    assert graph.get_rate("ABC", "USD") == pytest.approx(2)
+    assert graph.get_rate("UNKNOWN", "USD") is None
+    prices = dict(PRICES)
+    del prices["BTC/USDT"]
+    graph = ConversionGraph(get_tickers(prices))
+    assert graph.get_rate("ETH", "USD") is None
+    with pytest.raises(NotImplementedError):
+        graph.get_rate("ETH", "EUR")
+
+
+def test_updates_match_a_rebuilt_graph():
+    generator = random.Random(0)
+    prices = dict(PRICES)
+    graph = ConversionGraph(get_tickers(prices))
+    for _ in range(500):
+        symbol = generator.choice(sorted(PRICES))
+        if generator.random() < 0.1:
+            # Removed or listed again, the paths change
+            prices[symbol] = None if prices.get(symbol) else PRICES[symbol]
+        else:
+            prices[symbol] = (prices.get(symbol) or PRICES[symbol]) * generator.uniform(0.9, 1.1)
+        graph.update(symbol, {"symbol": symbol, "last": prices[symbol]})
+        expected = ConversionGraph(
+            get_tickers(dict((symbol, price) for symbol, price in prices.items() if price))
+        )
+        assert graph.rates == pytest.approx(expected.rates)
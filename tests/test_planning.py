@@ -0,0 +1,182 @@
+import copy
+
+import ccxt
+import numpy as np
+import pytest
+
+from cryptolio.planning import (MarketSnapshot, Planner, PlanningError,
+                                plan_rebalance, round_to_precision)
+from cryptolio.simulator import get_benchmark_data
+
+
+def get_market(symbol, amount_min=0.01, cost_min=0.0001, amount_precision=2, price_precision=8):
+    return {
+        "symbol": symbol,
+        "limits": {"amount": {"min": amount_min, "max": None}, "cost": {"min": cost_min}},
+        "precision": {"amount": amount_precision, "price": price_precision},
+    }
+
+
+def get_planner(balances, prices, markets=None, **kwargs):
+    # A single platform with its */BTC prices
+    tickers = dict((symbol, {"symbol": symbol, "last": price}) for symbol, price in prices.items())
+    return Planner(
+        ["binance"],
+        {"binance": {"total": dict(balances)}},
+        {"binance": tickers},
+        {"binance": markets or dict((symbol, get_market(symbol)) for symbol in prices)},
+        precision_modes={"binance": ccxt.DECIMAL_PLACES},
+        **kwargs
+    )
+
+
+@pytest.mark.parametrize(
+    "value, precision, mode, down, up",
+    [
+        (1.23456, 2, ccxt.DECIMAL_PLACES, 1.23, 1.24),
+        (0.29, 2, ccxt.DECIMAL_PLACES, 0.29, 0.29),
+        (123.456, 0, ccxt.DECIMAL_PLACES, 123, 124),
+        (0.00123456, 3, ccxt.SIGNIFICANT_DIGITS, 0.00123, 0.00124),
+        (98765.4, 2, ccxt.SIGNIFICANT_DIGITS, 98000, 99000),
+        (0.0537, 0.005, ccxt.TICK_SIZE, 0.05, 0.055),
+        (0.0001, 0.0001, ccxt.TICK_SIZE, 0.0001, 0.0001),
+        (0.0537, np.nan, ccxt.DECIMAL_PLACES, 0.0537, 0.0537),
+    ],
+)
+def test_round_to_precision(value, precision, mode, down, up):
+    values = np.array([value])
+    precisions = np.array([precision], dtype=float)
+    modes = np.array([mode])
+    assert round_to_precision(values, precisions, modes)[0] == down
+    assert round_to_precision(values, precisions, modes, round_up=True)[0] == up
+
+
+def test_round_to_precision_mixed_modes():
+    rounded = round_to_precision(
+        np.array([1.23456, 0.00123456, 0.0537]),
+        np.array([2, 3, 0.005]),
+        np.array([ccxt.DECIMAL_PLACES, ccxt.SIGNIFICANT_DIGITS, ccxt.TICK_SIZE]),
+    )
+    assert list(rounded) == [1.23, 0.00123, 0.05]
+
+
+def test_deltas_round_amounts_and_prices():
+    planner = get_planner({"BTC": 1}, {"AAA/BTC": 0.0123456789})
+    delta = planner.get_deltas({"binance": {"BTC": 0.5, "AAA": 12.3456}})["binance"]
+    (order,) = delta["orders"]
+    assert order["amount"] == 12.34
+    # Buy price with the 3% trading slippage, rounded up to the price precision
+    assert order["price"] == 0.01271605
+    assert delta["buy"] == {"AAA": 12.34}
+
+
+def test_order_limits_skipped_for_btt_only():
+    planner = get_planner(
+        {"BTC": 1},
+        {"AAA/BTC": 0.001, "BTT/BTC": 0.00000001},
+        {
+            "AAA/BTC": get_market("AAA/BTC", cost_min=0.001),
+            "BTT/BTC": get_market("BTT/BTC", amount_min=1000, cost_min=0.001, amount_precision=0),
+        },
+    )
+    delta = planner.get_deltas({"binance": {"BTC": 0.99, "AAA": 0.5, "BTT": 500}})["binance"]
+    assert delta["ignored"] == ["AAA"]
+    assert [(order["crypto"], order["amount"]) for order in delta["orders"]] == [("BTT", 500)]
+
+
+def test_btt_without_btc_market_ignored():
+    planner = get_planner({"BTC": 1}, {"AAA/BTC": 0.001})
+    delta = planner.get_deltas({"binance": {"BTC": 0.9, "AAA": 50, "BTT": 500}})["binance"]
+    assert delta["ignored"] == ["BTT"]
+    assert [order["crypto"] for order in delta["orders"]] == ["AAA"]
+
+
+def get_market_data(number_of_cryptos=20, number_of_platforms=2):
+    listing, platforms = get_benchmark_data(number_of_cryptos, number_of_platforms)
+    balances = {}
+    tickers = {}
+    markets = {}
+    for platform, (platform_balances, prices) in platforms.items():
+        balances[platform] = {"total": platform_balances}
+        tickers[platform] = dict(
+            (symbol, {"symbol": symbol, "last": price}) for symbol, price in prices.items()
+        )
+        markets[platform] = dict((symbol, get_market(symbol)) for symbol in prices)
+    precision_modes = dict((platform, ccxt.DECIMAL_PLACES) for platform in platforms)
+    return balances, tickers, markets, listing, precision_modes
+
+
+def test_plan_rebalance_has_no_side_effects(capsys):
+    balances, tickers, markets, listing, precision_modes = get_market_data()
+    inputs = copy.deepcopy((balances, tickers, markets, listing))
+    settings = {"number_of_cryptos": 10, "capping_level": 0.2, "precision_modes": precision_modes}
+    plan = plan_rebalance(balances, tickers, markets, listing, settings)
+    assert (balances, tickers, markets, listing) == inputs
+    assert settings == {
+        "number_of_cryptos": 10,
+        "capping_level": 0.2,
+        "precision_modes": precision_modes,
+    }
+    assert capsys.readouterr() == ("", "")
+    assert plan["deltas"] and not plan["transfers"]
+    assert plan_rebalance(balances, tickers, markets, listing, settings) == plan
+
+
+def test_market_snapshot_plans_like_plan_rebalance():
+    balances, tickers, markets, listing, precision_modes = get_market_data()
+    snapshot = MarketSnapshot(tickers, markets, listing, precision_modes)
+    for number_of_cryptos in [10, 15, 19]:
+        settings = {"number_of_cryptos": number_of_cryptos, "precision_modes": precision_modes}
+        assert snapshot.plan(balances, settings) == plan_rebalance(
+            balances, tickers, markets, listing, settings
+        )
+
+
+def test_plan_rebalance_raises_planning_errors():
+    balances, tickers, markets, listing, precision_modes = get_market_data()
+    settings = {"manual_weightings": {"UNKNOWN": 0.1}, "precision_modes": precision_modes}
+    with pytest.raises(PlanningError):
+        plan_rebalance(balances, tickers, markets, listing, settings)
+
+
+def test_platform_balance_only_counts_btc_markets():
+    planner = get_planner(
+        {"BTC": 1, "ETH": 10, "ABC": 100, "NOPE": 5},
+        {"ETH/BTC": 0.05, "BTC/USDT": 20000, "ABC/USDT": 2},
+    )
+    # ABC is valued through USDT but cannot be sold for BTC
+    assert planner.get_platform_balance("binance") == pytest.approx(1.5)
+    assert planner.get_untradable_balance("binance") == pytest.approx(0.01)
+    assert len(planner.warnings) == 2
+    assert planner.get_crypto_price("ETH", currency="USD") == pytest.approx(1000)
+
+
+def test_netting_keeps_the_totals():
+    balances, tickers, markets, listing, precision_modes = get_market_data(30, 3)
+    settings = {"number_of_cryptos": 20, "precision_modes": precision_modes}
+    split_plan = plan_rebalance(balances, tickers, markets, listing, settings)
+    plan = plan_rebalance(balances, tickers, markets, listing, dict(settings, order_netting=True))
+    assert plan["ideal_portfolio"] == split_plan["ideal_portfolio"]
+    for crypto, values in plan["ideal_portfolio"].items():
+        quantity = sum(
+            portfolio.get(crypto, {"quantity": 0})["quantity"]
+            for portfolio in plan["portfolios"].values()
+        )
+        assert quantity == pytest.approx(values["quantity"], rel=0.01)
+    for platform, portfolio in plan["portfolios"].items():
+        value = sum(values["quantity"] * values["btc_price"] for values in portfolio.values())
+        assert value == pytest.approx(plan["platform_balances"][platform], rel=0.01)
+    # A crypto is never sold on one platform and bought on another
+    for crypto in plan["ideal_portfolio"]:
+        sides = set(
+            side
+            for delta in plan["deltas"].values()
+            for side in ["buy", "sell"]
+            if crypto in delta[side]
+        )
+        assert len(sides) <= 1 or crypto == "BTC"
+    traded = sum(order["cost"] for delta in plan["deltas"].values() for order in delta["orders"])
+    split_traded = sum(
+        order["cost"] for delta in split_plan["deltas"].values() for order in delta["orders"]
+    )
+    assert traded < split_traded
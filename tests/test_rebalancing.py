@@ -0,0 +1,68 @@
+from cryptolio.rebalancing import PortfolioManager, get_book_price
+from cryptolio.simulator import SimulatedExchange
+
+
+def get_manager(balances, prices, **kwargs):
+    exchange = SimulatedExchange(balances, prices, fill_rate=1, seed=0)
+    manager = PortfolioManager(
+        None, {}, exchanges={"simulated": exchange}, order_poll_interval=0, **kwargs
+    )
+    return manager, exchange
+
+
+BOOK = {
+    "bids": [[0.0099, 1.0], [0.0098, 2.0], [0.0095, 5.0]],
+    "asks": [[0.0101, 1.0], [0.0102, 2.0], [0.0105, 5.0]],
+}
+
+
+def test_book_price_walks_the_levels():
+    assert get_book_price(BOOK, "buy", 0.5) == 0.0101
+    assert get_book_price(BOOK, "buy", 1.0) == 0.0101
+    assert get_book_price(BOOK, "buy", 2.5) == 0.0102
+    assert get_book_price(BOOK, "sell", 3.5) == 0.0095
+    assert get_book_price(BOOK, "sell", 8.5) is None
+
+
+def test_order_price_bounded_by_slippage_and_rounded():
+    manager, exchange = get_manager({"BTC": 1}, {"AAA/BTC": 0.01}, trading_slippage=0.03)
+    manager.order_books["simulated"] = {"AAA/BTC": (0, BOOK)}
+    order = {"symbol": "AAA/BTC", "crypto": "AAA", "side": "buy", "amount": 2.5, "price": 0.0103}
+    assert manager.get_order_price("simulated", order) == 0.0102
+    # Deeper than the book, the price is the mid price with the trading slippage
+    order = dict(order, amount=100)
+    assert manager.get_order_price("simulated", order) == 0.0103
+    order = dict(order, side="sell")
+    assert manager.get_order_price("simulated", order) == 0.0097
+    order = dict(order, symbol="BBB/BTC", crypto="BBB", price=0.5)
+    assert manager.get_order_price("simulated", order) == 0.5
+
+
+def test_order_below_cost_min_after_repricing_is_skipped(capsys):
+    manager, exchange = get_manager(
+        {"BTC": 1, "AAA": 10, "BBB": 10}, {"AAA/BTC": 0.00004, "BBB/BTC": 0.001}
+    )
+    # Planned at a stale price, the book now values the AAA sell below the 0.0001 BTC minimum
+    delta = {
+        "orders": [
+            {
+                "symbol": "AAA/BTC",
+                "crypto": "AAA",
+                "side": "sell",
+                "amount": 2.0,
+                "price": 0.0001,
+                "cost": 0.0002,
+            },
+            {
+                "symbol": "BBB/BTC",
+                "crypto": "BBB",
+                "side": "sell",
+                "amount": 2.0,
+                "price": 0.001,
+                "cost": 0.002,
+            },
+        ]
+    }
+    manager.apply_delta("simulated", delta)
+    assert [order["symbol"] for order in exchange.orders.values()] == ["BBB/BTC"]
+    assert "AAA skipped" in capsys.readouterr().out
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import ccxt
+import pytest
+
+from cryptolio import scheduler as scheduler_module
+from cryptolio.scheduler import RequestScheduler, TokenBucket
+
+
+class FakeExchange:
+    rateLimit = 1
+
+    def __init__(self, failures=()):
+        self.calls = []
+        self.failures = list(failures)
+
+    def fetch_ticker(self, symbol):
+        self.calls.append(time.monotonic())
+        if self.failures:
+            raise self.failures.pop(0)
+        return symbol
+
+    def create_limit_buy_order(self, symbol, amount, price):
+        return self.fetch_ticker(symbol)
+
+
+def test_token_bucket_delay():
+    bucket = TokenBucket(4, capacity=2)
+    now = bucket.timestamp
+    assert bucket.get_delay(now) == 0
+    bucket.consume()
+    bucket.consume()
+    assert bucket.get_delay(now) == pytest.approx(0.25)
+    assert bucket.get_delay(now + 0.125) == pytest.approx(0.125)
+    # Refilled up to its capacity only
+    assert bucket.get_delay(now + 10) == 0
+    assert bucket.tokens == 2
+    bucket.empty(now + 10)
+    assert bucket.get_delay(now + 10) == pytest.approx(0.25)
+
+
+def test_requests_spaced_by_platform_rate():
+    scheduler = RequestScheduler({"fake": 20})
+    exchange = scheduler.register("fake", FakeExchange())
+    for _ in range(5):
+        scheduler.call("fake", "fetch_ticker", "BTC/USDT")
+    gaps = [end - start for start, end in zip(exchange.calls[:-1], exchange.calls[1:])]
+    assert min(gaps) >= 0.045
+
+
+def test_network_errors_retried_on_fetches():
+    scheduler = RequestScheduler({"fake": 1000}, backoff=0.001)
+    exchange = scheduler.register(
+        "fake", FakeExchange([ccxt.RequestTimeout("timeout"), ccxt.DDoSProtection("busy")])
+    )
+    assert scheduler.call("fake", "fetch_ticker", "BTC/USDT") == "BTC/USDT"
+    assert len(exchange.calls) == 3
+
+
+def test_orders_only_retried_when_refused():
+    scheduler = RequestScheduler({"fake": 1000}, backoff=0.001)
+    exchange = scheduler.register("fake", FakeExchange([ccxt.DDoSProtection("busy")]))
+    assert scheduler.call("fake", "create_limit_buy_order", "ETH/BTC", 1, 0.05) == "ETH/BTC"
+    assert len(exchange.calls) == 2
+    # The order may have been placed, a timeout is never retried
+    exchange = scheduler.register("other", FakeExchange([ccxt.RequestTimeout("timeout")]))
+    with pytest.raises(ccxt.RequestTimeout):
+        scheduler.call("other", "create_limit_buy_order", "ETH/BTC", 1, 0.05)
+    assert len(exchange.calls) == 1
+
+
+def test_retries_limited():
+    scheduler = RequestScheduler({"fake": 1000}, max_retries=2, backoff=0.001)
+    exchange = scheduler.register("fake", FakeExchange([ccxt.NetworkError("down")] * 5))
+    with pytest.raises(ccxt.NetworkError):
+        scheduler.call("fake", "fetch_ticker", "BTC/USDT")
+    assert len(exchange.calls) == 3
+
+
+class SlowTokenBucket(TokenBucket):
+    # Widens the window between checking for a bucket and storing it
+    def __init__(self, rate, capacity=1):
+        time.sleep(0.01)
+        super().__init__(rate, capacity)
+
+
+def test_endpoint_bucket_shared_by_concurrent_first_calls(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "TokenBucket", SlowTokenBucket)
+    scheduler = RequestScheduler({"fake.fetch_ticker": 50})
+    exchange = scheduler.register("fake", FakeExchange())
+    barrier = threading.Barrier(11)
+
+    def call():
+        barrier.wait()
+        scheduler.call("fake", "fetch_ticker", "BTC/USDT")
+
+    threads = [threading.Thread(target=call) for _ in range(11)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len([key for key in scheduler.buckets if key.startswith("fake.")]) == 1
+    # 10 requests after the first one at 50 per second
+    assert exchange.calls[-1] - exchange.calls[0] >= 0.19
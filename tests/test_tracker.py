@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from cryptolio.tracker import DriftTracker
+
+
+def get_brute_force_drift(tracker):
+    drifts = [tracker.get_drift(crypto) for crypto in tracker.values]
+    return max(drifts, key=abs)
+
+
+def test_max_drift_follows_price_updates():
+    generator = random.Random(0)
+    cryptos = ["C" + str(i) for i in range(20)]
+    targets = dict((crypto, 1 / 15) for crypto in cryptos[:15])
+    prices = dict((crypto, generator.uniform(1, 10)) for crypto in cryptos)
+    quantities = dict((crypto, 1 / 15 / prices[crypto]) for crypto in cryptos[:15])
+    quantities["C18"] = 0.001
+    tracker = DriftTracker(quantities, prices, targets, drift_band=0.5)
+    assert tracker.get_max_drift()[1] == pytest.approx(get_brute_force_drift(tracker))
+    # Enough updates to go through several lazy heap rebuilds
+    for _ in range(2000):
+        crypto = generator.choice(cryptos)
+        prices[crypto] *= generator.lognormvariate(0, 0.05)
+        tracker.update_price(crypto, prices[crypto])
+        crypto, drift = tracker.get_max_drift()
+        assert drift == pytest.approx(get_brute_force_drift(tracker))
+        assert tracker.get_drift(crypto) == pytest.approx(drift)
+    assert len(tracker.max_ratios) <= 4 * len(targets) + 17
+    nav = sum(quantity * prices[crypto] for crypto, quantity in quantities.items())
+    assert tracker.nav == pytest.approx(nav)
+
+
+def test_stray_crypto_compared_to_smallest_target():
+    tracker = DriftTracker(
+        {"BTC": 0.55, "ETH": 0.4, "DOGE": 0.05},
+        {"BTC": 1, "ETH": 1, "DOGE": 1},
+        {"BTC": 0.6, "ETH": 0.4},
+    )
+    assert tracker.get_max_drift() == ("DOGE", pytest.approx(0.125))
+
+
+def test_drift_notified_once_per_excursion():
+    events = []
+    tracker = DriftTracker(
+        {"BTC": 1, "ETH": 1}, {"BTC": 1, "ETH": 1}, {"BTC": 0.5, "ETH": 0.5}, 0.2, events.append
+    )
+    assert tracker.check() is None
+    event = tracker.update_price("ETH", 2)
+    assert event["crypto"] in ["BTC", "ETH"] and abs(event["drift"]) == pytest.approx(1 / 3)
+    assert tracker.update_price("ETH", 2.5) is None
+    assert tracker.update_price("ETH", 1) is None
+    assert tracker.update_price("ETH", 2) is not None
+    assert len(events) == 2